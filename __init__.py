@@ -49,6 +49,9 @@ from string import Template
 from StringIO import StringIO
 import logging
 from time import time
+from hashlib import sha1
+from email.utils import formatdate, parsedate_tz, mktime_tz
+import calendar
 
 # Copy our Version into the config so that our renders can access it
 conf["viur.version"] = __version__
@@ -184,7 +187,7 @@ def setDefaultDomainLanguage( domain, lang ):
 
 ### Multi-Language Part: END
 
-from server import session, errors
+from server import session, errors, ratelimit
 from server.tasks import TaskHandler, runStartupTasks
 
 def buildApp( config, renderers, default=None, *args, **kwargs ):
@@ -335,9 +338,17 @@ class BrowseHandler(webapp.RequestHandler):
 		if translations is None:
 			# This project doesn't use the multi-language feature, nothing to do here
 			return( path )
+		# Don't load the session just to find out that there is none
+		hasSession = session.current.hasSessionCookie( self )
 		if conf["viur.languageMethod"] == "session":
+			if not hasSession:
+				# No session yet; guess the language, but don't create a session just to store it
+				if "X-Appengine-Country" in self.request.headers:
+					lng = self.request.headers["X-Appengine-Country"].lower()
+					if lng in conf["viur.availableLanguages"]+list( conf["viur.languageAliasMap"].keys() ):
+						self.language = lng
 			# We store the language inside the session, try to load it from there
-			if not session.current.getLanguage():
+			elif not session.current.getLanguage():
 				if "X-Appengine-Country" in self.request.headers:
 					lng = self.request.headers["X-Appengine-Country"].lower()
 					if lng in conf["viur.availableLanguages"]+list( conf["viur.languageAliasMap"].keys() ):
@@ -355,7 +366,7 @@ class BrowseHandler(webapp.RequestHandler):
 			if host in conf["viur.domainLanguageMapping"]:
 				self.language = conf["viur.domainLanguageMapping"][ host ]
 			else: # We have no language configured for this domain, try to read it from session
-				if session.current.getLanguage():
+				if hasSession and session.current.getLanguage():
 					self.language = session.current.getLanguage()
 		elif conf["viur.languageMethod"] == "url":
 			tmppath = urlparse.urlparse( path ).path
@@ -364,7 +375,7 @@ class BrowseHandler(webapp.RequestHandler):
 				self.language = tmppath[0]
 				return( path[ len( tmppath[0])+1: ] ) #Return the path stripped by its language segment
 			else: # This URL doesnt contain an language prefix, try to read it from session
-				if session.current.getLanguage():
+				if hasSession and session.current.getLanguage():
 					self.language = session.current.getLanguage()
 				elif "X-Appengine-Country" in self.request.headers.keys():
 					lng = self.request.headers["X-Appengine-Country"].lower()
@@ -435,7 +446,7 @@ class BrowseHandler(webapp.RequestHandler):
 				self.redirect( "https://%s/" % host )
 				return
 		try:
-			session.current.load( self ) # self.request.cookies )
+			session.current.load( self ) # The session is read on first access
 			path = self.selectLanguage( path )
 			if conf["viur.requestPreprocessor"]:
 				path = conf["viur.requestPreprocessor"]( path )
@@ -444,6 +455,9 @@ class BrowseHandler(webapp.RequestHandler):
 			if conf["viur.debug.traceExceptions"]:
 				raise
 			self.redirect( e.url.encode("UTF-8") )
+		except errors.NotModified as e:
+			self.response.clear()
+			self.response.set_status( 304 )
 		except errors.HTTPException as e:
 			if conf["viur.debug.traceExceptions"]:
 				raise
@@ -486,6 +500,8 @@ class BrowseHandler(webapp.RequestHandler):
 			self.response.out.write( res )
 
 		finally:
+			# Also on 304: the view may have changed the session before NotModified was raised. Sessions which
+			# haven't been accessed or changed aren't written anyway.
 			self.saveSession( )
 
 
@@ -515,11 +531,16 @@ class BrowseHandler(webapp.RequestHandler):
 		self.pathlist = [ urlparse.unquote( x ) for x in path.strip("/").split("/") ]
 		caller = conf["viur.mainApp"]
 		idx = 0 #Count how may items from *args we'd have consumed (so the rest can go into *args of the called func
+		guards = [] # Objects along the path having a canAccess function; they're checked after the rate limit
+		def checkAccess():
+			for guard in guards:
+				if not guard.canAccess():
+					# We have a canAccess function guarding that object,
+					# and it returns False...
+					raise( errors.Unauthorized() )
 		for currpath in self.pathlist:
-			if "canAccess" in dir( caller ) and not caller.canAccess():
-				# We have a canAccess function guarding that object,
-				# and it returns False...
-				raise( errors.Unauthorized() )
+			if "canAccess" in dir( caller ):
+				guards.append( caller )
 			idx += 1
 			currpath = currpath.replace("-", "_").replace(".", "_")
 			if currpath in dir( caller ):
@@ -533,8 +554,10 @@ class BrowseHandler(webapp.RequestHandler):
 					args = self.pathlist[ idx-1 : ] + [ x for x in args ]
 					break
 				else:
+					checkAccess()
 					raise( errors.NotFound( "The path %s could not be found" % "/".join( [ ("".join([ y for y in x if y.lower() in "0123456789abcdefghijklmnopqrstuvwxyz"]) ) for x in self.pathlist[ : idx ] ] ) ) )
 			else:
+				checkAccess()
 				raise( errors.NotFound( "The path %s could not be found" % "/".join( [ ("".join([ y for y in x if y.lower() in "0123456789abcdefghijklmnopqrstuvwxyz"]) ) for x in self.pathlist[ : idx ] ] ) ) )
 		if (not callable( caller ) or ((not "exposed" in dir( caller ) or not caller.exposed)) and (not "internalExposed" in dir( caller ) or not caller.internalExposed or not self.internalRequest)):
 			if "index" in dir( caller ) \
@@ -543,7 +566,12 @@ class BrowseHandler(webapp.RequestHandler):
 				or ("internalExposed" in dir( caller.index ) and caller.index.internalExposed and self.internalRequest)):
 					caller = caller.index
 			else:
+				checkAccess()
 				raise( errors.MethodNotAllowed() )
+		# Check the rate limit of that function (before anything else is done for this request)
+		if not self.internalRequest and "rateLimit" in dir( caller ) and caller.rateLimit:
+			self.checkRateLimit( caller )
+		checkAccess()
 		# Check for forceSSL flag
 		if not self.internalRequest \
 			and "forceSSL" in dir( caller ) \
@@ -575,7 +603,12 @@ class BrowseHandler(webapp.RequestHandler):
 		try:
 			if (conf["viur.debug.traceExternalCallRouting"] and not self.internalRequest) or conf["viur.debug.traceInternalCallRouting"]:
 				logging.debug("Calling %s with args=%s and kwargs=%s" % (str(caller),unicode(args), unicode(kwargs)))
-			self.response.out.write( caller( *self.args, **self.kwargs ) )
+			res = caller( *self.args, **self.kwargs )
+			if conf["viur.conditionalRequests"] and not self.internalRequest and self.request.method in ("GET", "HEAD") \
+			  and self.response.status_int == 200 and isinstance( res, basestring ) and not "ETag" in self.response.headers:
+				# Provide a strong validator for this response (if the client's copy matches, we're done)
+				self.checkNotModified( etag=sha1( res.encode("UTF-8") if isinstance( res, unicode ) else res ).hexdigest() )
+			self.response.out.write( res )
 		except TypeError as e:
 			if self.internalRequest: #We provide that "service" only for requests originating from outside
 				raise
@@ -603,6 +636,65 @@ class BrowseHandler(webapp.RequestHandler):
 			raise
 
 
+	def checkNotModified( self, etag=None, lastModified=None ):
+		"""
+			Emits the given validators and checks them against the conditional headers sent by the client.
+			If the client's copy is still valid, :class:`server.errors.NotModified` is raised, so the
+			response will be answered with 304 (and the caller can skip generating that response).
+
+			Only applies to external GET/HEAD requests and only if conf["viur.conditionalRequests"] is set.
+
+			:param etag: The (strong) entity-tag of the response, without quotes
+			:type etag: str
+			:param lastModified: The date the response has been modified the last time
+			:type lastModified: datetime
+		"""
+		if not conf["viur.conditionalRequests"] or self.internalRequest or self.isPostRequest:
+			return
+		ifNoneMatch = self.request.headers.get("If-None-Match")
+		if etag:
+			etag = '"%s"' % etag
+			self.response.headers["ETag"] = etag
+			if ifNoneMatch:
+				tags = [ x.strip() for x in ifNoneMatch.split(",") ]
+				if "*" in tags or etag in [ (x[2:] if x.startswith("W/") else x) for x in tags ]:
+					raise errors.NotModified()
+		if lastModified:
+			if lastModified.tzinfo is not None:
+				lastModified = lastModified.utctimetuple()
+			else:
+				lastModified = lastModified.timetuple()
+			lastModified = calendar.timegm( lastModified )
+			self.response.headers["Last-Modified"] = formatdate( lastModified, usegmt=True )
+			ifModifiedSince = self.request.headers.get("If-Modified-Since")
+			if ifModifiedSince and not ifNoneMatch: # If-None-Match takes precedence if present
+				try:
+					ifModifiedSince = mktime_tz( parsedate_tz( ifModifiedSince ) )
+				except TypeError: # Unparsable date
+					return
+				if lastModified <= ifModifiedSince:
+					raise errors.NotModified()
+
+	def checkRateLimit( self, caller ):
+		"""
+			Consumes one call from the rate limit set on *caller* using :func:`server.rateLimited`.
+
+			:raises: :class:`server.errors.TooManyRequests` if that limit has been exceeded
+		"""
+		limit = caller.rateLimit
+		resource = limit["resource"]
+		if not resource:
+			# Functions of the same module share their quota across all renders
+			owner = getattr( caller, "im_self", None )
+			if owner is not None:
+				resource = "%s.%s" % ( getattr( owner, "_moduleName", None ) or owner.__class__.__name__, caller.__name__ )
+			else:
+				resource = "%s.%s" % ( caller.__module__, caller.__name__ )
+		gate = ratelimit.RateLimit( resource, limit["maxRate"], limit["minutes"], limit["method"] )
+		if not gate.isQuotaAvailable():
+			raise errors.TooManyRequests()
+		gate.decrementQuota()
+
 	def saveSession(self):
 		session.current.save( self )
 
@@ -689,6 +781,29 @@ def exposed( f ):
 	f.exposed = True
 	return( f )
 
+def rateLimited( maxRate, minutes=1, method="ip", resource=None ):
+	"""
+		Decorator, which limits the calls to an exposed function to *maxRate* calls within *minutes*.
+
+		Calls are counted per ip, per user or per session (see :class:`server.ratelimit.RateLimit`).
+		Requests exceeding that limit are rejected with 429 - Too Many Requests before the function
+		is called. Internal requests are not limited.
+
+		:param maxRate: Amount of calls allowed within the given time-span
+		:type maxRate: int
+		:param minutes: Length of the time-span in minutes
+		:type minutes: int
+		:param method: Count calls by IP, by the current user or by the current session
+		:type method: 'ip' | 'user' | 'session'
+		:param resource: Name of the quota; defaults to the name of the module and function
+		:type resource: str
+	"""
+	assert method in ["ip", "user", "session"], "method must be 'ip', 'user' or 'session'"
+	def wrapper( f ):
+		f.rateLimit = { "maxRate": maxRate, "minutes": minutes, "method": method, "resource": resource }
+		return( f )
+	return( wrapper )
+
 def internalExposed( f ):
 	"""
 		Decorator, marks an function as internal exposed.
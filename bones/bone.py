@@ -198,6 +198,19 @@ class baseBone(object): # One Bone:
 			valuesCache[name] = expando[ name ]
 		return( True )
 
+	def isSerializationOutdated( self, name, entity ):
+		"""
+			Checks if the value stored in *entity* uses an outdated storage format.
+			If so, this bone will be serialized again on the next write even if its value didn't change.
+
+			:param name: The property-name this bone has in its Skeleton (not the description!)
+			:type name: str
+			:param entity: The db.Entity as read from the datastore
+			:type entity: db.Entity
+			:returns: bool
+		"""
+		return( False )
+
 	def buildDBFilter( self, name, skel, dbFilter, rawFilter, prefix=None ):
 		"""
 			Parses the searchfilter a client specified in his Request into
@@ -7,8 +7,97 @@ from server.utils import normalizeKey
 from google.appengine.api import search
 import extjson
 from time import time
-from datetime import datetime
-import logging
+from datetime import datetime, date, time as dtTime
+import logging, json
+
+__storageFormatPrefix__ = "v2:"  # Prefix of values stored as compact (stdlib) json instead of extjson
+__extjsonFormatPrefix__ = "x2:"  # Prefix of values written by encodeRelation that had to fall back to extjson
+__dateTag__ = "__viur_date__"  # Marks datetime/date/time objects inside values stored in the v2 format
+
+
+def _encodeDate(obj):
+	"""
+		Hook for json.dumps, tagging datetime, date and time objects so that :func:`_decodeDate` can restore them.
+	"""
+	if isinstance(obj, datetime):
+		return {__dateTag__: "datetime", "v": obj.timetuple()[:6] + (obj.microsecond,)}
+	elif isinstance(obj, date):
+		return {__dateTag__: "date", "v": obj.timetuple()[:3]}
+	elif isinstance(obj, dtTime):
+		return {__dateTag__: "time", "v": (obj.hour, obj.minute, obj.second, obj.microsecond)}
+	raise TypeError("%r is not JSON serializable" % obj)
+
+
+def _decodeDate(obj):
+	"""
+		Object hook for json.loads, inverse of :func:`_encodeDate`.
+	"""
+	if __dateTag__ not in obj:
+		return obj
+	typeName = obj[__dateTag__]
+	if typeName == "datetime":
+		return datetime(*obj["v"])
+	elif typeName == "date":
+		return date(*obj["v"])
+	return dtTime(*obj["v"])
+
+
+def encodeRelation(value):
+	"""
+		Encodes one value of a relationalBone (its dest- and rel-data) for storing it in the datastore.
+
+		Values are stored as compact json (datetime, date and time objects are tagged), which decodes
+		considerably faster than extjson. Values containing other types are stored using extjson, prefixed
+		so that they're not mistaken for values written by previous versions.
+
+		:param value: Dictionary with the serialized "dest" and "rel" data
+		:type value: dict
+		:returns: str
+	"""
+	try:
+		return __storageFormatPrefix__ + json.dumps(value, separators=(",", ":"), default=_encodeDate)
+	except (TypeError, ValueError):
+		return __extjsonFormatPrefix__ + extjson.dumps(value)
+
+
+def decodeRelation(val):
+	"""
+		Inverse of :func:`encodeRelation`. Values stored using extjson by previous versions are read transparently.
+
+		:param val: The value as read from the datastore
+		:type val: str | unicode
+		:returns: dict
+	"""
+	if val.startswith(__storageFormatPrefix__):
+		return json.loads(val[len(__storageFormatPrefix__):], object_hook=_decodeDate)
+	elif val.startswith(__extjsonFormatPrefix__):
+		return extjson.loads(val[len(__extjsonFormatPrefix__):])
+	return extjson.loads(val)
+
+
+def _normalizeDates( value ):
+	"""
+		Converts timezone-aware datetime objects (as produced by localized dateBones) inside *value*
+		into naive ones in UTC, which is how the datastore returns them.
+	"""
+	if isinstance( value, datetime ) and value.tzinfo is not None:
+		return( ( value - value.utcoffset() ).replace( tzinfo=None ) )
+	elif isinstance( value, list ):
+		return( [ _normalizeDates( x ) for x in value ] )
+	return( value )
+
+
+def _relationPropertiesDiffer( dbObj, newValues ):
+	"""
+		Checks if any of the properties in *newValues* differs from the viur-relations entry *dbObj*.
+	"""
+	for k, v in newValues.items():
+		try:
+			if _normalizeDates( dbObj.get( k ) ) != _normalizeDates( v ):
+				return( True )
+		except TypeError: # Still incomparable; rewriting it doesn't hurt
+			return( True )
+	return( False )
 
 
 class relationalBone( baseBone ):
@@ -121,10 +210,10 @@ class relationalBone( baseBone ):
 	def _restoreValueFromDatastore(self, val):
 		"""
 			Restores one of our values (including the Rel- and Using-Skel) from the serialized data read from the datastore
-			:param value: Json-Encoded datastore property
+			:param value: Encoded datastore property (see :func:`encodeRelation`)
 			:return: Our Value (with restored RelSkel and using-Skel)
 		"""
-		value = extjson.loads(val)
+		value = decodeRelation(val)
 		assert isinstance(value, dict), "Read something from the datastore thats not a dict: %s" % str(type(value))
 
 		relSkel = self._refSkelCache
@@ -225,7 +314,7 @@ class relationalBone( baseBone ):
 					else:
 						usingData = None
 					r = {"rel": usingData, "dest": refData}
-					res.append(extjson.dumps(r))
+					res.append(encodeRelation(r))
 				entity.set( name, res, False )
 			else:
 				refSkel = self._refSkelCache
@@ -241,7 +330,7 @@ class relationalBone( baseBone ):
 				else:
 					usingData = None
 				r = {"rel": usingData, "dest": refData}
-				entity.set(name, extjson.dumps(r), False)
+				entity.set(name, encodeRelation(r), False)
 				#Copy attrs of our referenced entity in
 				if self.indexed:
 					if refData:
@@ -255,6 +344,16 @@ class relationalBone( baseBone ):
 					#		entity[ "%s.%s" % (name,k) ] = v
 		return entity
 
+	def isSerializationOutdated( self, name, entity ):
+		"""
+			Values written by previous versions (plain extjson) are rewritten using :func:`encodeRelation` on the next write.
+		"""
+		val = entity.get( name )
+		if not isinstance( val, list ):
+			val = [ val ]
+		return any( [ isinstance( x, basestring ) and not x.startswith( ( __storageFormatPrefix__, __extjsonFormatPrefix__ ) )
+				for x in val ] )
+
 	def postSavedHandler( self, valuesCache, boneName, skel, key, dbfields ):
 		if boneName not in valuesCache:
 			return
@@ -277,31 +376,27 @@ class relationalBone( baseBone ):
 		dbVals.filter("viur_dest_kind =", self.kind)
 		dbVals.filter("viur_src_property =", boneName )
 
+		# Collect all changes, so they can be written with one Put and one Delete
+		putList = []
+		deleteList = []
+
 		for dbObj in dbVals.iter():
 			try:
 				if not dbObj[ "dest.key" ] in [ x["dest"]["key"] for x in values ]: #Relation has been removed
-					db.Delete( dbObj.key() )
+					deleteList.append( dbObj.key() )
 					continue
 			except: #This entry is corrupt
-				db.Delete( dbObj.key() )
+				deleteList.append( dbObj.key() )
 			else: # Relation: Updated
 				data = [x for x in values if x["dest"]["key"] == dbObj["dest.key"]][0]
 				if self.indexed: #We dont store more than key and kinds, and these dont change
-					#Write our (updated) values in
-					refSkel = self._refSkelCache
-					refSkel.setValuesCache(data["dest"])
-					for k, v in refSkel.serialize().items():
-						dbObj[ "dest."+k ] = v
-					for k,v in parentValues.items():
-						dbObj[ "src."+k ] = v
-					if self.using is not None:
-						usingSkel = self._usingSkelCache
-						usingSkel.setValuesCache(data["rel"])
-						for k, v in usingSkel.serialize().items():
-							dbObj[ "rel."+k ] = v
-					dbObj[ "viur_delayed_update_tag" ] = time()
-					dbObj["viur_relational_updateLevel"] = self.updateLevel
-					db.Put( dbObj )
+					#Only write our values back if they differ from the stored ones
+					newValues = self._getRelationProperties( data, parentValues )
+					newValues["viur_relational_updateLevel"] = self.updateLevel
+					if _relationPropertiesDiffer( dbObj, newValues ):
+						dbObj.update( newValues )
+						dbObj[ "viur_delayed_update_tag" ] = time()
+						putList.append( dbObj )
 				values.remove( data )
 
 		# Add any new Relation
@@ -312,17 +407,7 @@ class relationalBone( baseBone ):
 				dbObj[ "dest.key" ] = val["dest"]["key"]
 				dbObj[ "src.key" ] = key
 			else:
-				refSkel = self._refSkelCache
-				refSkel.setValuesCache(val["dest"])
-				for k, v in refSkel.serialize().items():
-					dbObj[ "dest."+k ] = v
-				for k,v in parentValues.items():
-					dbObj[ "src."+k ] = v
-				if self.using is not None:
-					usingSkel = self._usingSkelCache
-					usingSkel.setValuesCache(val["rel"])
-					for k, v in usingSkel.serialize().items():
-						dbObj[ "rel."+k ] = v
+				dbObj.update( self._getRelationProperties( val, parentValues ) )
 
 			dbObj[ "viur_delayed_update_tag" ] = time()
 			dbObj[ "viur_src_kind" ] = skel.kindName #The kind of the entry referencing
@@ -331,7 +416,30 @@ class relationalBone( baseBone ):
 			#dbObj[ "viur_dest_key" ] = val["key"]
 			dbObj[ "viur_dest_kind" ] = self.kind
 			dbObj["viur_relational_updateLevel"] = self.updateLevel
-			db.Put( dbObj )
+			putList.append( dbObj )
+
+		if putList:
+			db.Put( putList )
+		if deleteList:
+			db.Delete( deleteList )
+
+	def _getRelationProperties( self, value, parentValues ):
+		"""
+			Assembles the dest.*, src.* and rel.* properties of the viur-relations entry for one of our values.
+		"""
+		res = {}
+		refSkel = self._refSkelCache
+		refSkel.setValuesCache(value["dest"])
+		for k, v in refSkel.serialize().items():
+			res[ "dest."+k ] = v
+		for k,v in parentValues.items():
+			res[ "src."+k ] = v
+		if self.using is not None:
+			usingSkel = self._usingSkelCache
+			usingSkel.setValuesCache(value["rel"])
+			for k, v in usingSkel.serialize().items():
+				res[ "rel."+k ] = v
+		return res
 
 	def postDeletedHandler( self, skel, key, id ):
 		db.Delete( [x for x in db.Query( "viur-relations" ).ancestor( db.Key( id ) ).run( keysOnly=True ) ] )
@@ -732,6 +840,62 @@ class relationalBone( baseBone ):
 						res.append( "src.%s" % orderKey )
 		return( res )
 
+	def getRefreshKeys(self, valuesCache, boneName):
+		"""
+			Returns the (normalized) keys of all entities :func:`refresh` will read.
+
+			:returns: List of string-encoded keys
+			:rtype: list of str
+		"""
+		if not valuesCache.get(boneName) or self.updateLevel == 2:
+			return []
+
+		values = valuesCache[boneName]
+		if isinstance(values, dict):
+			values = [values]
+		elif not isinstance(values, list):
+			return []
+
+		res = []
+		for relDict in values:
+			if isinstance(relDict, dict) and isinstance(relDict.get("dest"), dict) and relDict["dest"].get("key"):
+				res.append(normalizeKey(relDict["dest"]["key"]))
+
+		return res
+
+	def fetchReferencedEntities(self, keys, skel=None):
+		"""
+			Fetches the entities referenced by *keys* with one batched read.
+
+			Entities already fetched by :func:`server.skeleton.BaseSkeleton.refresh` for all relationalBones
+			of *skel* are taken from there.
+
+			:param keys: List of string-encoded keys
+			:type keys: list of str
+			:param skel: The skeleton this bone belongs to
+			:type skel: server.skeleton.BaseSkeleton
+
+			:returns: Dictionary of str(key) -> db.Entity (or None if that entity does not exist)
+			:rtype: dict
+		"""
+		prefetched = getattr(skel, "_prefetchedEntities", None) or {}
+		res = {}
+		missingKeys = []
+
+		for key in keys:
+			if key in prefetched:
+				res[key] = prefetched[key]
+			elif key not in res:
+				res[key] = None
+				missingKeys.append(key)
+
+		if missingKeys:
+			for entity in db.Get(missingKeys):
+				if entity is not None:
+					res[str(entity.key())] = entity
+
+		return res
+
 	def refresh(self, valuesCache, boneName, skel):
 		"""
 			Refresh all values we might have cached from other entities.
@@ -761,18 +925,13 @@ class relationalBone( baseBone ):
 			# Try to update referenced values;
 			# If the entity does not exist with this key, ignore
 			# (key was overidden above to have a new appid when transferred).
-			newValues = None
+			newValues = entities.get(entityKey)
 
-			try:
-				newValues = db.Get(entityKey)
-				assert newValues is not None
-			except db.EntityNotFoundError:
+			if newValues is None:
 				#This entity has been deleted
 				logging.info("The key %s does not exist" % entityKey)
-			except:
-				raise
 
-			if newValues:
+			else:
 				for key in self._refSkelCache.keys():
 					if key == "key":
 						continue
@@ -784,6 +943,9 @@ class relationalBone( baseBone ):
 
 		logging.debug("Refreshing relationalBone %s of %s" % (boneName, skel.kindName))
 
+		# Fetch all referenced entities at once
+		entities = self.fetchReferencedEntities(self.getRefreshKeys(valuesCache, boneName), skel)
+
 		if isinstance(valuesCache[boneName], dict):
 			updateInplace(valuesCache[boneName])
 
@@ -873,7 +1035,7 @@ class relationalBone( baseBone ):
 			if not key.kind() == self.kind:
 				logging.error("I got a key, which kind doesn't match my type! (Got: %s, my type %s)" % (key.kind(), self.kind))
 				return None
-			entity = db.Get(key)
+			entity = entities.get(str(key))
 			if not entity:
 				logging.error("Key %s not found" % str(key))
 				return None
@@ -912,6 +1074,13 @@ class relationalBone( baseBone ):
 				realValue = [value]
 			else:
 				realValue = value
+		# Resolve all keys given at once
+		if not self.multiple:
+			keys = [realValue[0]]
+		else:
+			keys = [x[0] for x in realValue]
+		keys = [str(x) if isinstance(x, db.Key) else str(db.Key(encoded=x)) for x in keys]
+		entities = self.fetchReferencedEntities([x for x in keys if db.Key(x).kind() == self.kind])
 		if not self.multiple:
 			relSkel = relSkelFromKey(realValue[0])
 			if not relSkel:
@@ -2,7 +2,7 @@
 from server.bones import baseBone
 from math import pow, floor, ceil
 from server import db
-import logging
+import logging, heapq
 import math
 
 def haversine(lat1, lng1, lat2, lng2):
@@ -253,7 +253,8 @@ class spatialBone( baseBone ):
 		tmpDict = {}
 		for item in (latRight+latLeft+lngBottom+lngTop):
 			tmpDict[str(item.key())] = item
-		# Build up the final results
-		tmpList = [(haversine(x[name+".lat.val"],x[name+".lng.val"],lat,lng),x) for x in tmpDict.values()]
-		tmpList.sort( key=lambda x: x[0])
-		return [x[1] for x in tmpList[:targetAmount]]
+		# Build up the final results - we only need the targetAmount nearest ones, so select them using a heap
+		tmpList = heapq.nsmallest(targetAmount,
+		                          ((haversine(x[name+".lat.val"],x[name+".lng.val"],lat,lng),x) for x in tmpDict.values()),
+		                          key=lambda x: x[0])
+		return [x[1] for x in tmpList]
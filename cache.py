@@ -1,7 +1,8 @@
 # -*- coding: utf-8 -*-
 from server import db, utils, request, tasks, session
 from server.config import conf
-from hashlib import sha512
+from google.appengine.api import memcache
+from hashlib import sha512, sha1
 from datetime import datetime, timedelta
 import logging
 from functools import wraps
@@ -18,6 +19,14 @@ from functools import wraps
 
 
 viurCacheName = "viur-cache"
+__memcacheNamespace__ = "viur-cache"  # Namespace of the memcache tier in front of the viur-cache entities
+__rebuildLockPrefix__ = "viur-cache-rebuild:"  # Prefix of the lock held while an expired entry is rebuilt
+__rebuildLockTime__ = 30  # Seconds other requests will be served the stale entry while it's rebuilt
+__maxStaleTime__ = 300  # Seconds after its expiry an entry is no longer served stale, even if a rebuild is in progress
+__flushBatchSize__ = 500  # Amount of entries deleted at once by flushCache
+__maxDependencyKeys__ = 100  # If more entities of one kind have been read, the entry depends on the whole kind instead
+
+_cacheInUse = False  # Set as soon as enableCache has been applied to any function
 
 
 
@@ -102,6 +111,111 @@ def keyFromArgs( f, userSensitive, languageSensitive, evaluatedArgs, path, args,
 	return( mysha512.hexdigest() )
 
 
+def getCacheEntry( key ):
+	"""
+		Fetches the cached response for *key*, trying memcache first and the datastore second.
+
+		:param key: The key as returned by keyFromArgs
+		:type key: str
+		:returns: The cache entry (a dict-like object with data, creationtime, path and content-type) or None
+	"""
+	entry = memcache.get( key, namespace=__memcacheNamespace__ )
+	if entry:
+		return( entry )
+	try:
+		entry = db.Get( db.Key.from_path( viurCacheName, key ) )
+	except db.EntityNotFoundError:
+		return( None )
+	try:
+		memcache.set( key, dict( entry.items() ), namespace=__memcacheNamespace__ )
+	except ValueError: # Too large for memcache, we'll read it from the datastore
+		pass
+	return( entry )
+
+def storeCacheEntry( key, data, path, contentType, dependencies=None ):
+	"""
+		Writes a response into both tiers of the cache.
+
+		:param dependencies: Tuple of (entity keys, kind names) read while generating *data*, as returned \
+		by :func:`server.db.stopDependencyTracking`. The entry will be flushed if any of them is changed.
+		:type dependencies: (set, set)
+	"""
+	dbEntity = db.Entity( viurCacheName, name=key )
+	dbEntity[ "data" ] = data
+	dbEntity[ "creationtime" ] = datetime.now()
+	dbEntity[ "path" ] = path
+	dbEntity[ "content-type"] = contentType
+	dbEntity[ "etag" ] = sha1( data.encode("UTF-8") if isinstance( data, unicode ) else data ).hexdigest()
+	if dependencies:
+		dbEntity[ "dependencies" ] = buildDependencyList( *dependencies )
+	dbEntity.set_unindexed_properties( ["data","content-type","etag"] ) #We can save 3 DB-Writs :)
+	db.Put( dbEntity )
+	try:
+		memcache.set( key, dict( dbEntity.items() ), namespace=__memcacheNamespace__ )
+	except ValueError:
+		memcache.delete( key, namespace=__memcacheNamespace__ )
+	return( dbEntity )
+
+def buildDependencyList( keys, kinds ):
+	"""
+		Converts the keys and kinds read while generating an entry into the values stored in its
+		(indexed) dependencies property.
+	"""
+	kinds = set( kinds )
+	keysByKind = {}
+	for key in keys:
+		keysByKind.setdefault( db.Key( key ).kind(), [] ).append( key )
+	res = []
+	for kind, kindKeys in keysByKind.items():
+		if len( kindKeys ) > __maxDependencyKeys__:
+			kinds.add( kind )
+		elif kind not in kinds:
+			res.extend( kindKeys )
+	res.extend( [ "kind:%s" % x for x in kinds ] )
+	return( res )
+
+def flushDependentEntries( kindName, key=None ):
+	"""
+		Flushes all cache entries that depend on the entity *key* or the kind *kindName*.
+		Called by :func:`server.skeleton.Skeleton.toDB` and :func:`server.skeleton.Skeleton.delete`.
+
+		:param kindName: Kind of the entity that has been changed
+		:type kindName: str
+		:param key: Key of the entity that has been changed (or None if unknown)
+		:type key: str
+	"""
+	if not _cacheInUse:
+		return
+	if db.IsInTransaction():
+		# Non-ancestor queries aren't allowed inside transactions; flush once the caller's transaction committed
+		flushDependentEntriesDeferred( kindName, str( key ) if key else None, _transactional=True )
+		return
+	_flushDependentEntries( kindName, key )
+
+@tasks.callDeferred
+def flushDependentEntriesDeferred( kindName, key=None ):
+	"""
+		Runs :func:`flushDependentEntries` in a deferred task; used if it's called inside a transaction.
+	"""
+	_flushDependentEntries( kindName, key )
+
+def _flushDependentEntries( kindName, key=None ):
+	"""
+		Does the actual work of :func:`flushDependentEntries`. Must not be called inside a transaction.
+	"""
+	dependencies = [ "kind:%s" % kindName ]
+	if key:
+		dependencies.append( str( key ) )
+	keys = set()
+	for dependency in dependencies:
+		keys.update( db.Query( viurCacheName ).filter( "dependencies =", dependency ).iter( keysOnly=True ) )
+	if not keys:
+		return
+	keys = list( keys )
+	db.Delete( keys )
+	memcache.delete_multi( [ x.name() for x in keys ], namespace=__memcacheNamespace__ )
+	logging.debug( "Flushed %s cache entries depending on %s" % ( len( keys ), ", ".join( dependencies ) ) )
+
 def wrapCallable(f, urls, userSensitive, languageSensitive, evaluatedArgs, maxCacheTime):
 	"""
 		Does the actual work of wrapping a callable.
@@ -128,26 +242,37 @@ def wrapCallable(f, urls, userSensitive, languageSensitive, evaluatedArgs, maxCa
 			# Someting is wrong (possibly the parameter-count)
 			# Letz call f, but we knew already that this will clash
 			return( f( self, *args, **kwargs ) )
-		try:
-			dbRes = db.Get( db.Key.from_path( viurCacheName, key ) )
-		except db.EntityNotFoundError:
-			dbRes = None
+		dbRes = getCacheEntry( key )
+		hasRebuildLock = False
 		if dbRes:
 			if not maxCacheTime or \
 			  dbRes["creationtime"] > datetime.now()-timedelta( seconds=maxCacheTime ):
 				# We store it unlimited or the cache is fresh enough
 				logging.debug( "This request was served from cache." )
 				currentRequest.response.headers['Content-Type'] = dbRes[ "content-type"].encode("UTF-8")
+				currentRequest.checkNotModified( etag=dbRes.get( "etag" ) )
+				return( dbRes["data"] )
+			# Its expired; only one request rebuilds it, all others get the stale entry meanwhile
+			hasRebuildLock = memcache.add( __rebuildLockPrefix__+key, True, time=__rebuildLockTime__ )
+			# add() also fails if memcache is unavailable, so only serve stale if the lock is actually held by someone
+			if not hasRebuildLock \
+			  and memcache.get( __rebuildLockPrefix__+key ) \
+			  and dbRes["creationtime"] > datetime.now()-timedelta( seconds=maxCacheTime+__maxStaleTime__ ):
+				logging.debug( "This request was served from cache (stale, rebuild in progress)." )
+				currentRequest.response.headers['Content-Type'] = dbRes[ "content-type"].encode("UTF-8")
+				currentRequest.checkNotModified( etag=dbRes.get( "etag" ) )
 				return( dbRes["data"] )
 		# If we made it this far, the request wasnt cached or too old; we need to rebuild it
-		res = f( self, *args, **kwargs )
-		dbEntity = db.Entity( viurCacheName, name=key )
-		dbEntity[ "data" ] = res
-		dbEntity[ "creationtime" ] = datetime.now()
-		dbEntity[ "path" ] = path
-		dbEntity[ "content-type"] = request.current.get().response.headers['Content-Type']
-		dbEntity.set_unindexed_properties( ["data","content-type"] ) #We can save 2 DB-Writs :)
-		db.Put( dbEntity )
+		try:
+			db.startDependencyTracking()
+			try:
+				res = f( self, *args, **kwargs )
+			finally:
+				dependencies = db.stopDependencyTracking()
+			storeCacheEntry( key, res, path, request.current.get().response.headers['Content-Type'], dependencies )
+		finally:
+			if hasRebuildLock:
+				memcache.delete( __rebuildLockPrefix__+key )
 		logging.debug( "This request was a cache-miss. Cache has been updated." )
 		return( res )
 	return wrapF
@@ -184,31 +309,49 @@ def enableCache( urls, userSensitive=0, languageSensitive=False, evaluatedArgs=[
 			If None, the cache stays valid forever (until manually erased by calling flushCache.
 		:type maxCacheTime: int or None
 
+		Entries record the entities and kinds read while they were generated; they're flushed as soon as one
+		of these entities (or any entity of a kind queried) is changed through a Skeleton.
 	"""
 	assert not any( [x.startswith("_") for x in evaluatedArgs]), "A evaluated Parameter cannot start with an underscore!"
+	global _cacheInUse
+	_cacheInUse = True
 	return lambda f: wrapCallable( f, urls, userSensitive, languageSensitive, evaluatedArgs, maxCacheTime )
 
 @tasks.callDeferred
-def flushCache( prefix="/*" ):
+def flushCache( prefix="/*", cursor=None, flushedCount=0 ):
 	"""
 		Flushes the cache. Its possible the flush only a part of the cache by specifying
 		the path-prefix.
 
+		Entries are deleted in chunks of __flushBatchSize__; each chunk schedules the next one,
+		so large prefixes can be flushed without running into the request deadline.
+
 		:param prefix: Path or prefix that should be flushed.
 		:type prefix: str
+		:param cursor: Internal; The cursor to continue from
+		:param flushedCount: Internal; How many entries have been flushed by the previous chunks
 
 		Examples:
 			- "/" would flush the main page (and only that),
 			- "/*" everything from the cache, "/page/*" everything from the page-module (default render),
 			- and "/page/view/*" only that specific subset of the page-module.
 	"""
-	items = db.Query( viurCacheName ).filter( "path =", prefix.rstrip("*") ).iter( keysOnly=True )
-	for item in items:
-		db.Delete( item )
+	path = prefix.rstrip("*")
 	if prefix.endswith("*"):
-		items = db.Query( viurCacheName ).filter( "path >", prefix.rstrip("*") ).filter( "path <", prefix.rstrip("*")+u"\ufffd").iter( keysOnly=True )
-		for item in items:
-			db.Delete( item )
-	logging.debug("Flushing cache succeeded. Everything matching \"%s\" is gone." % prefix )
+		query = db.Query( viurCacheName ).filter( "path >=", path ).filter( "path <", path+u"\ufffd" )
+	else:
+		query = db.Query( viurCacheName ).filter( "path =", path )
+	if cursor:
+		query.cursor( cursor )
+	keys = query.run( __flushBatchSize__, keysOnly=True )
+	if keys:
+		db.Delete( keys )
+		memcache.delete_multi( [ x.name() for x in keys ], namespace=__memcacheNamespace__ )
+	flushedCount += len( keys )
+	if len( keys ) == __flushBatchSize__:
+		logging.info( "Flushing cache for \"%s\": %s entries flushed so far" % ( prefix, flushedCount ) )
+		flushCache( prefix, query.getCursor().urlsafe(), flushedCount )
+	else:
+		logging.debug("Flushing cache succeeded. Everything matching \"%s\" is gone (%s entries)." % ( prefix, flushedCount ) )
 
-__all__ = [ "enableCache", "flushCache" ]
+__all__ = [ "enableCache", "flushCache", "flushDependentEntries" ]
@@ -13,9 +13,16 @@ conf = {
 
 	"viur.cacheEnvironmentKey": None, #If set, this function will be called for each cache-attempt and the result will be included in the computed cache-key
 	"viur.capabilities": [], #Extended functionality of the whole System (For module-dependend functionality advertise this in the module configuration (adminInfo)
+	"viur.conditionalRequests": True, #If set, GET-responses carry an ETag and matching If-None-Match requests are answered with 304 Not Modified
+	"viur.conditionalRequests.useChangedate": False, #If set, single-entry views also emit Last-Modified (from changedate) and honour If-Modified-Since. Only enable if these views don't depend on anything else (like the current user)
 	"viur.contentSecurityPolicy": None, #If set, viur will emit a CSP http-header with each request. Use the csp module to set this property
 
 	"viur.db.caching" : 2, #Cache strategy used by the database. 2: Aggressive, 1: Safe, 0: Off
+	"viur.db.instanceCacheSize": 0, #If > 0, db.Get keeps up to this many entities in a per-instance LRU cache in front of memcache
+	"viur.db.instanceCacheTime": 30, #Seconds an entity stays in the per-instance cache. Changes made on other instances may be invisible for that long!
+	"viur.db.queryCache": False, #If set, results of queries created by skel.all() are cached as key lists, invalidated per kind by db.Put/db.Delete
+	"viur.db.requestCache": True, #If set, entities read by db.Get are kept in memory for the rest of the current request
+	"viur.db.requestCacheSize": 1000, #Max. number of entities kept by the request cache; the least recently used ones are evicted first
 	"viur.debug.traceExceptions": False, #If enabled, user-generated exceptions from the server.errors module won't be caught and handled
 	"viur.debug.traceExternalCallRouting": False, #If enabled, ViUR will log which (exposed) function are called from outside with what arguments
 	"viur.debug.traceInternalCallRouting": False, #If enabled, ViUR will log which (internal-exposed) function are called from templates with what arguments
@@ -66,9 +73,16 @@ conf = {
 	"viur.security.xXssProtection": True, # ViUR will emit a X-XSS-Protection header if set (the default),
 	"viur.security.xContentTypeOptions": True, # ViUR will emit X-Content-Type-Options: nosniff Header unless set to False
 	"viur.security.xPermittedCrossDomainPolicies": "none",  # Unless set to logical none; ViUR will emit a X-Permitted-Cross-Domain-Policies with each request
+	"viur.securityKey.replayProtection": True, #If set, signed security keys are remembered in memcache once used, so they can't be used again (while memcache keeps them)
+	"viur.securityKey.signed": False, #If set, security keys without data are HMAC-signed tokens (bound to the session) instead of datastore entities
+	"viur.session.backend": None, #If set, sessions are handled by this class instead of session.GaeSession (fe. session.CookieSession)
+	"viur.session.cookieEncryption": False, #If set, CookieSession encrypts the sessions it stores client-side (requires pycrypto)
+	"viur.session.cookieMaxSize": 2048, #CookieSession moves a session to the datastore as soon as its cookie would exceed this size (bytes)
 	"viur.session.lifeTime": 60*60, #Default is 60 minutes lifetime for ViUR sessions
+	"viur.session.persistInterval": 5*60, #Sessions live in memcache; changes are written through to the datastore at most once per interval (seconds) unless they are security relevant (new session, login, logout)
 	"viur.session.persistentFieldsOnLogin": [], #If set, these Fields will survive the session.reset() called on user/login
 	"viur.session.persistentFieldsOnLogout": [], #If set, these Fields will survive the session.reset() called on user/logout
+	"viur.session.sizeBudget": 16*1024, #A warning is logged for each session exceeding this size (bytes, serialized). See session.getSizeStats()
 	"viur.skeleton.searchPath": ["/skeletons/", "/server/"], # Priority, in which skeletons are loaded
 
 	"viur.tasks.customEnvironmentHandler": None, #If set, must be a tuple of two functions serializing/restoring additional enviromental data in deferred requests,
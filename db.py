@@ -4,6 +4,11 @@ from google.appengine.datastore import datastore_query, datastore_rpc
 from google.appengine.api import memcache
 from google.appengine.api import search
 from server.config import conf
+from server import request
+from collections import OrderedDict
+from threading import Lock, local
+from time import time
+from hashlib import sha256
 import logging
 
 
@@ -20,8 +25,344 @@ __cacheLockTime__ = 42 #Prevent an entity from creeping into the cache for 42 Se
 __cacheTime__ = 15*60 #15 Mins
 __CacheKeyPrefix__ ="viur-db-cache:" #Our Memcache-Namespace. Dont use that for other purposes
 __MemCacheBatchSize__ = 30
+__QueryCacheKeyPrefix__ = "viur-db-querycache:" #Memcache-Namespace for cached query results
+__KindGenerationKeyPrefix__ = "viur-db-kindgeneration:" #Memcache-Namespace for the per-kind generation counters
+__RequestCacheKey__ = "viur-db-requestcache" #Key inside request.current.requestData() holding our per-request cache
+__DependencyTrackerKey__ = "viur-db-dependencies" #Key inside request.current.requestData() holding the active dependency trackers
 __undefinedC__ = object()
 
+_instanceCache = OrderedDict() #Bounded per-instance cache (LRU), only used if conf["viur.db.instanceCacheSize"] > 0
+_instanceCacheLock = Lock()
+_cacheStats = {"requestHits": 0, "instanceHits": 0, "memcacheHits": 0, "datastoreReads": 0}
+_txnState = local() #Kinds written by the transaction currently running in this thread (see RunInTransactionOptions)
+
+
+def _getRequestCache():
+	"""
+		Returns the dictionary used to cache entities for the current request,
+		or None if we're not called from inside a request (or that cache is disabled).
+	"""
+	if not conf["viur.db.requestCache"]:
+		return( None )
+	try:
+		reqData = request.current.requestData()
+	except AttributeError: #No request set (yet)
+		return( None )
+	if not __RequestCacheKey__ in reqData:
+		reqData[ __RequestCacheKey__ ] = OrderedDict()
+	return( reqData[ __RequestCacheKey__ ] )
+
+def _requestCacheSet( requestCache, entities ):
+	"""
+		Stores *entities* (a dictionary of str(key) -> Entity) in *requestCache*, evicting the least
+		recently used entries beyond conf["viur.db.requestCacheSize"].
+	"""
+	for key, entity in entities.items():
+		requestCache.pop( key, None )
+		requestCache[ key ] = entity
+	while len( requestCache ) > conf["viur.db.requestCacheSize"]:
+		requestCache.popitem( last=False )
+
+def _copyEntity( entity ):
+	"""
+		Returns a copy of *entity* that can be safely handed out to the caller.
+
+		Entities served from our in-process caches are shared between all readers,
+		so we must not return the cached object itself.
+	"""
+	res = Entity.FromDatastoreEntity( entity )
+	for k, v in res.items():
+		if isinstance( v, list ):
+			res[ k ] = v[ : ]
+	return( res )
+
+def _localCacheGet( keys ):
+	"""
+		Looks up the given (string-encoded) *keys* in the request- and instance-cache.
+
+		:returns: Dictionary of str(key) -> Entity for all keys found.
+		:rtype: dict
+	"""
+	res = {}
+	requestCache = _getRequestCache()
+	if requestCache:
+		for key in keys:
+			if key in requestCache:
+				entity = requestCache.pop( key )
+				requestCache[ key ] = entity #Mark as recently used
+				res[ key ] = _copyEntity( entity )
+		_cacheStats["requestHits"] += len( res )
+	if conf["viur.db.instanceCacheSize"] > 0:
+		minTime = time() - conf["viur.db.instanceCacheTime"]
+		instanceHits = {}
+		with _instanceCacheLock:
+			for key in keys:
+				if key in res or not key in _instanceCache:
+					continue
+				ctime, entity = _instanceCache.pop( key )
+				if ctime < minTime: #Too old, drop it
+					continue
+				_instanceCache[ key ] = (ctime, entity) #Mark as recently used
+				instanceHits[ key ] = entity
+		_cacheStats["instanceHits"] += len( instanceHits )
+		if requestCache is not None:
+			_requestCacheSet( requestCache, instanceHits )
+		for key, entity in instanceHits.items():
+			res[ key ] = _copyEntity( entity )
+	return( res )
+
+def _localCacheSet( entities ):
+	"""
+		Stores the given *entities* in the request- and instance-cache.
+	"""
+	requestCache = _getRequestCache()
+	if requestCache is not None:
+		_requestCacheSet( requestCache, { str( x.key() ): _copyEntity( x ) for x in entities } )
+	maxSize = conf["viur.db.instanceCacheSize"]
+	if maxSize > 0:
+		now = time()
+		with _instanceCacheLock:
+			for entity in entities:
+				key = str( entity.key() )
+				_instanceCache.pop( key, None )
+				_instanceCache[ key ] = ( now, _copyEntity( entity ) )
+			while len( _instanceCache ) > maxSize:
+				_instanceCache.popitem( last=False )
+
+def _localCacheInvalidate( keys ):
+	"""
+		Removes the given (string-encoded) *keys* from the request- and instance-cache.
+	"""
+	requestCache = _getRequestCache()
+	if requestCache:
+		for key in keys:
+			requestCache.pop( key, None )
+	if _instanceCache:
+		with _instanceCacheLock:
+			for key in keys:
+				_instanceCache.pop( key, None )
+
+def getCacheStats():
+	"""
+		Returns the hit/miss counters of our entity caches since the instance started
+		(or :func:`server.db.resetCacheStats` has been called).
+
+		*requestHits* and *instanceHits* are entities served from memory without any RPC,
+		*memcacheHits* have been served by memcache and *datastoreReads* had to be fetched
+		from the datastore.
+
+		:rtype: dict
+	"""
+	return( dict( _cacheStats ) )
+
+def resetCacheStats():
+	"""
+		Resets the counters returned by :func:`server.db.getCacheStats`.
+	"""
+	for k in _cacheStats.keys():
+		_cacheStats[ k ] = 0
+
+def startDependencyTracking():
+	"""
+		Starts recording the keys of all entities fetched by :func:`server.db.Get` and the kinds of all
+		queries run within the current request, until :func:`server.db.stopDependencyTracking` is called.
+		Trackers can be nested; reads are recorded by all active trackers.
+	"""
+	try:
+		reqData = request.current.requestData()
+	except AttributeError: #No request set (yet)
+		return
+	reqData.setdefault( __DependencyTrackerKey__, [] ).append( ( set(), set() ) )
+
+def stopDependencyTracking():
+	"""
+		Stops the tracker most recently started by :func:`server.db.startDependencyTracking`.
+
+		:returns: Tuple of (set of string-encoded keys, set of kind names) read meanwhile
+		:rtype: (set, set)
+	"""
+	try:
+		trackers = request.current.requestData().get( __DependencyTrackerKey__ )
+	except AttributeError: #No request set (yet)
+		trackers = None
+	if not trackers:
+		return( set(), set() )
+	return( trackers.pop() )
+
+def _trackDependencies( keys=(), kinds=() ):
+	"""
+		Records *keys* and *kinds* in all active dependency trackers.
+	"""
+	try:
+		trackers = request.current.requestData().get( __DependencyTrackerKey__ )
+	except AttributeError: #No request set (yet)
+		return
+	if not trackers:
+		return
+	for trackedKeys, trackedKinds in trackers:
+		trackedKeys.update( [ str(x) for x in keys ] )
+		trackedKinds.update( [ x for x in kinds if x ] )
+
+def flushLocalCache():
+	"""
+		Drops all entities from the request- and instance-cache of the current instance.
+		This does *not* flush memcache.
+	"""
+	requestCache = _getRequestCache()
+	if requestCache:
+		requestCache.clear()
+	with _instanceCacheLock:
+		_instanceCache.clear()
+
+def _memcacheChunks( items ):
+	"""
+		Splits *items* into chunks of at most __MemCacheBatchSize__ entries.
+	"""
+	items = list( items )
+	return( [ items[ i : i+__MemCacheBatchSize__ ] for i in range( 0, len( items ), __MemCacheBatchSize__ ) ] )
+
+def _memcacheGetMulti( keys ):
+	"""
+		Fetches the given (string-encoded) *keys* from memcache.
+
+		All chunks are requested in parallel.
+
+		:returns: Dictionary of str(key) -> Entity for all keys found.
+		:rtype: dict
+	"""
+	client = memcache.Client()
+	rpcs = [ client.get_multi_async( chunk, namespace=__CacheKeyPrefix__ ) for chunk in _memcacheChunks( keys ) ]
+	res = {}
+	for rpc in rpcs:
+		res.update( rpc.get_result() or {} )
+	return( res )
+
+def _memcacheSetMulti( entities ):
+	"""
+		Writes *entities* (a dictionary of str(key) -> Entity) into memcache.
+
+		All chunks are written in parallel; failures are silently ignored.
+	"""
+	client = memcache.Client()
+	rpcs = []
+	for chunk in _memcacheChunks( entities.items() ):
+		try:
+			rpcs.append( client.set_multi_async( dict( chunk ), time=__cacheTime__, namespace=__CacheKeyPrefix__ ) )
+		except:
+			pass
+	for rpc in rpcs:
+		try:
+			rpc.get_result()
+		except:
+			pass
+
+def _invalidateCache( keys ):
+	"""
+		Removes the given *keys* from all cache tiers and prevents them from being
+		cached again for __cacheLockTime__ seconds.
+
+		Memcache is cleared with one delete_multi per chunk, all chunks in parallel.
+	"""
+	keys = [ str( x ) for x in keys ]
+	if not keys:
+		return
+	_localCacheInvalidate( keys )
+	client = memcache.Client()
+	rpcs = [ client.delete_multi_async( chunk, seconds=__cacheLockTime__, namespace=__CacheKeyPrefix__ )
+			for chunk in _memcacheChunks( keys ) ]
+	for rpc in rpcs:
+		rpc.get_result()
+
+
+def _getKindGenerations( kinds ):
+	"""
+		Returns the current generation counters for the given *kinds*.
+
+		Missing counters are initialized with the current time, so an evicted counter
+		never falls back to a value it already had.
+
+		:returns: List of (kind, generation) tuples or None if memcache is unavailable.
+		:rtype: list | None
+	"""
+	kinds = sorted( set( kinds ) )
+	res = memcache.get_multi( kinds, namespace=__KindGenerationKeyPrefix__ )
+	missing = [ x for x in kinds if not x in res ]
+	if missing:
+		memcache.add_multi( { x: int( time()*1000 ) for x in missing }, namespace=__KindGenerationKeyPrefix__ )
+		res.update( memcache.get_multi( missing, namespace=__KindGenerationKeyPrefix__ ) )
+		if any( [ not x in res for x in kinds ] ):
+			return( None )
+	return( [ ( x, res[ x ] ) for x in kinds ] )
+
+def invalidateQueryCache( kindName ):
+	"""
+		Invalidates all cached query results for the given kind by bumping its generation counter.
+
+		:func:`server.db.Put` and :func:`server.db.Delete` (and their asynchronous variants) already do this for each
+		kind written once the write succeeded; inside a transaction started by :func:`server.db.RunInTransaction`
+		(or its variants) only after the transaction has been committed. Call it yourself after transactions started
+		directly on the datastore API, as queries run between the write and the commit may cache the old result again.
+
+		:param kindName: Name of the kind that has been modified.
+		:type kindName: str
+	"""
+	if not conf["viur.db.queryCache"]:
+		return
+	memcache.incr( kindName, namespace=__KindGenerationKeyPrefix__, initial_value=int( time()*1000 ) )
+
+def _invalidateQueryCacheForKinds( kinds ):
+	"""
+		Invalidates the cached query results of all given kinds with one memcache call.
+		Our internal kinds (viur-*) are skipped, as they're never queried through skeletons.
+
+		Inside a transaction started by :func:`server.db.RunInTransactionOptions`, the kinds are only
+		recorded and invalidated after the transaction has been committed.
+	"""
+	if not conf["viur.db.queryCache"]:
+		return
+	kinds = set( [ x for x in kinds if not x.startswith("viur") ] )
+	if not kinds:
+		return
+	pendingKinds = getattr( _txnState, "kinds", None )
+	if pendingKinds is not None and datastore.IsInTransaction():
+		pendingKinds.update( kinds )
+		return
+	memcache.offset_multi( { x: 1 for x in kinds }, namespace=__KindGenerationKeyPrefix__, initial_value=int( time()*1000 ) )
+
+class _InvalidatingRPC( object ):
+	"""
+		Wraps the RPC returned by :func:`server.db.PutAsync` and :func:`server.db.DeleteAsync`,
+		invalidating the query cache of the given kinds once the write succeeded.
+	"""
+	def __init__( self, rpc, kinds ):
+		self.rpc = rpc
+		self.kinds = kinds
+
+	def get_result( self ):
+		res = self.rpc.get_result()
+		if self.kinds is not None:
+			kinds, self.kinds = self.kinds, None
+			_invalidateQueryCacheForKinds( kinds )
+		return( res )
+
+	def __getattr__( self, name ):
+		return( getattr( self.rpc, name ) )
+
+def _getKinds( keys ):
+	"""
+		Returns the kinds of the given key, entity or list of keys/entities.
+	"""
+	if not isinstance( keys, list ):
+		keys = [ keys ]
+	res = set()
+	for key in keys:
+		if isinstance( key, datastore.Entity ):
+			res.add( key.kind() )
+		elif isinstance( key, basestring ):
+			res.add( datastore_types.Key( encoded=key ).kind() )
+		else:
+			res.add( key.kind() )
+	return( res )
 
 def PutAsync( entities, **kwargs ):
 	"""
@@ -40,13 +381,10 @@ def PutAsync( entities, **kwargs ):
 	if conf["viur.db.caching" ]>0:
 		if isinstance( entities, Entity ): #Just one:
 			if entities.is_saved(): #Its an update
-				memcache.delete( str( entities.key() ), namespace=__CacheKeyPrefix__, seconds=__cacheLockTime__  )
+				_invalidateCache( [ entities.key() ] )
 		elif isinstance( entities, list ):
-			for entity in entities:
-				assert isinstance( entity, Entity )
-				if entity.is_saved(): #Its an update
-					memcache.delete( str( entity.key() ), namespace=__CacheKeyPrefix__, seconds=__cacheLockTime__  )
-	return( datastore.PutAsync( entities, **kwargs ) )
+			_invalidateCache( [ x.key() for x in entities if x.is_saved() ] ) #Only updates
+	return( _InvalidatingRPC( datastore.PutAsync( entities, **kwargs ), _getKinds( entities ) ) )
 
 def Put( entities, **kwargs ):
 	"""
@@ -78,13 +416,12 @@ def Put( entities, **kwargs ):
 	if conf["viur.db.caching" ]>0:
 		if isinstance( entities, Entity ): #Just one:
 			if entities.is_saved(): #Its an update
-				memcache.delete( str( entities.key() ), namespace=__CacheKeyPrefix__, seconds=__cacheLockTime__  )
+				_invalidateCache( [ entities.key() ] )
 		elif isinstance( entities, list ):
-			for entity in entities:
-				assert isinstance( entity, Entity )
-				if entity.is_saved(): #Its an update
-					memcache.delete( str( entity.key() ), namespace=__CacheKeyPrefix__, seconds=__cacheLockTime__  )
-	return( datastore.Put( entities, **kwargs ) )
+			_invalidateCache( [ x.key() for x in entities if x.is_saved() ] ) #Only updates
+	res = datastore.Put( entities, **kwargs )
+	_invalidateQueryCacheForKinds( _getKinds( entities ) )
+	return( res )
 
 def GetAsync( keys, **kwargs ):
 	"""
@@ -104,11 +441,23 @@ def GetAsync( keys, **kwargs ):
 
 		def get_result( self ):
 			return( self.res )
+	_trackDependencies( keys=keys if isinstance( keys, list ) else [ keys ] )
 	if conf["viur.db.caching" ]>0 and not datastore.IsInTransaction():
 		if isinstance( keys, datastore_types.Key ) or isinstance( keys, basestring ): #Just one:
+			res = _localCacheGet( [ str(keys) ] ).get( str(keys) )
+			if res:
+				return( AsyncResultWrapper( res ) )
 			res = memcache.get( str(keys), namespace=__CacheKeyPrefix__ )
 			if res:
+				_cacheStats["memcacheHits"] += 1
+				_localCacheSet( [ res ] )
 				return( AsyncResultWrapper( res ) )
+		elif isinstance( keys, list ):
+			# We can only answer that from our local caches if all keys are there
+			keyList = [ str(x) for x in keys ]
+			localRes = _localCacheGet( keyList )
+			if len( localRes ) == len( set( keyList ) ):
+				return( AsyncResultWrapper( [ localRes[ x ] for x in keyList ] ) )
 	#Either the result wasnt found, or we got a list of keys to fetch;
 	# --> no caching possible
 	return( datastore.GetAsync( keys, **kwargs ) )
@@ -139,49 +488,51 @@ def Get( keys, **kwargs ):
 		:returns: Entity or list of Entity objects corresponding to the specified key(s).
 		:rtype: :class:`server.db.Entity` | list of :class:`server.db.Entity`
 	"""
+	_trackDependencies( keys=keys if isinstance( keys, list ) else [ keys ] )
 	if conf["viur.db.caching" ]>0  and not datastore.IsInTransaction():
 		if isinstance( keys, datastore_types.Key ) or isinstance( keys, basestring ): #Just one:
+			res = _localCacheGet( [ str(keys) ] ).get( str(keys) )
+			if res:
+				return( res )
 			res = memcache.get( str(keys), namespace=__CacheKeyPrefix__ )
 			if not res: #Not cached - fetch and cache it :)
 				res = Entity.FromDatastoreEntity( datastore.Get( keys, **kwargs ) )
 				res[ "key" ] = str( res.key() )
 				memcache.set( str(res.key() ), res, time=__cacheTime__, namespace=__CacheKeyPrefix__ )
+				_cacheStats["datastoreReads"] += 1
+			else:
+				_cacheStats["memcacheHits"] += 1
+			_localCacheSet( [ res ] )
 			return( res )
 		#Either the result wasnt found, or we got a list of keys to fetch;
 		elif isinstance( keys,list ):
-			#Check Memcache first
-			cacheRes = {}
-			tmpRes = []
+			#Check our local caches first, then memcache
 			keyList = [ str(x) for x in keys ]
-			while keyList: #Fetch in Batches of 30 entries, as the max size for bulk_get is limited to 32MB
-				currentBatch = keyList[:__MemCacheBatchSize__]
-				keyList = keyList[__MemCacheBatchSize__:]
-				cacheRes.update( memcache.get_multi( currentBatch, namespace=__CacheKeyPrefix__) )
+			cacheRes = _localCacheGet( keyList )
+			localHits = len( cacheRes )
+			#Fetched in Batches of 30 entries, as the max size for bulk_get is limited to 32MB
+			memcacheRes = _memcacheGetMulti( OrderedDict.fromkeys( [ x for x in keyList if not x in cacheRes ] ) )
+			_cacheStats["memcacheHits"] += len( memcacheRes )
+			_localCacheSet( memcacheRes.values() )
+			cacheRes.update( memcacheRes )
 			#Fetch the rest from DB
 			missigKeys = [ x for x in keys if not str(x) in cacheRes ]
-			dbRes = [ Entity.FromDatastoreEntity(x) for x in datastore.Get( missigKeys ) if x is not None ]
+			dbRes = {}
+			if missigKeys:
+				for x in datastore.Get( missigKeys ):
+					if x is not None:
+						dbRes[ str( x.key() ) ] = Entity.FromDatastoreEntity( x )
+			_cacheStats["datastoreReads"] += len( dbRes )
+			_localCacheSet( dbRes.values() )
 			# Cache what we had fetched
-			saveIdx = 0
-			while len(dbRes)>saveIdx*__MemCacheBatchSize__:
-				cacheMap = {str(obj.key()): obj for obj in dbRes[saveIdx*__MemCacheBatchSize__:(saveIdx+1)*__MemCacheBatchSize__]}
-				try:
-					memcache.set_multi( cacheMap, time=__cacheTime__ , namespace=__CacheKeyPrefix__ )
-				except:
-					pass
-				saveIdx += 1
-			for key in [ str(x) for x in keys ]:
-				if key in cacheRes:
-					tmpRes.append( cacheRes[ key ] )
-				else:
-					for e in dbRes:
-						if str( e.key() ) == key:
-							tmpRes.append ( e )
-							break
+			_memcacheSetMulti( dbRes )
+			cacheRes.update( dbRes )
+			tmpRes = [ cacheRes.get( key ) for key in keyList ]
 			if conf["viur.debug.traceQueries"]:
-				logging.debug( "Fetched a result-set from Datastore: %s total, %s from cache, %s from datastore" % (len(tmpRes),len( cacheRes.keys()), len( dbRes ) ) )
+				logging.debug( "Fetched a result-set from Datastore: %s total, %s from local cache, %s from memcache, %s from datastore" % (len(cacheRes), localHits, len( memcacheRes ), len( dbRes ) ) )
 			return( tmpRes )
 	if isinstance( keys, list ):
-		return( [ Entity.FromDatastoreEntity(x) for x in datastore.Get( keys, **kwargs ) ] )
+		return( [ Entity.FromDatastoreEntity(x) if x is not None else None for x in datastore.Get( keys, **kwargs ) ] )
 	else:
 		return( Entity.FromDatastoreEntity( datastore.Get( keys, **kwargs ) ) )
 
@@ -226,7 +577,7 @@ def GetOrInsert( key, kindName=None, parent=None, **kwargs ):
 	if datastore.IsInTransaction():
 		return txn(key, kwargs)
 
-	return datastore.RunInTransaction( txn, key, kwargs )
+	return RunInTransaction( txn, key, kwargs )
 
 def DeleteAsync(keys, **kwargs):
 	"""
@@ -237,13 +588,15 @@ def DeleteAsync(keys, **kwargs):
 		block on the call and get the results.
 	"""
 	if conf["viur.db.caching" ]>0:
-		if isinstance( keys, datastore_types.Key ): #Just one:
-			memcache.delete( str( keys ), namespace=__CacheKeyPrefix__, seconds=__cacheLockTime__  )
+		if isinstance( keys, datastore_types.Key ) or isinstance( keys, basestring ): #Just one:
+			_invalidateCache( [ keys ] )
+		elif isinstance( keys, Entity ):
+			_invalidateCache( [ keys.key() ] )
 		elif isinstance( keys, list ):
 			for key in keys:
 				assert isinstance( key, datastore_types.Key ) or isinstance( key, basestring )
-				memcache.delete( str( key ), namespace=__CacheKeyPrefix__, seconds=__cacheLockTime__  )
-	return( datastore.DeleteAsync( keys, **kwargs ) )
+			_invalidateCache( keys )
+	return( _InvalidatingRPC( datastore.DeleteAsync( keys, **kwargs ), _getKinds( keys ) ) )
 
 def Delete(keys, **kwargs):
 	"""
@@ -266,12 +619,53 @@ def Delete(keys, **kwargs):
 	"""
 	if conf["viur.db.caching" ]>0:
 		if isinstance( keys, datastore_types.Key ) or isinstance( keys, basestring ): #Just one:
-			memcache.delete( str( keys ), namespace=__CacheKeyPrefix__, seconds=__cacheLockTime__  )
+			_invalidateCache( [ keys ] )
+		elif isinstance( keys, Entity ):
+			_invalidateCache( [ keys.key() ] )
 		elif isinstance( keys, list ):
 			for key in keys:
 				assert isinstance( key, datastore_types.Key ) or isinstance( key, basestring )
-				memcache.delete( str( key ), namespace=__CacheKeyPrefix__, seconds=__cacheLockTime__  )
-	return( datastore.Delete( keys, **kwargs ) )
+			_invalidateCache( keys )
+	res = datastore.Delete( keys, **kwargs )
+	_invalidateQueryCacheForKinds( _getKinds( keys ) )
+	return( res )
+
+def RunInTransactionOptions( options, function, *args, **kwargs ):
+	"""
+		Runs *function* in a transaction, using the given :class:`server.db.TransactionOptions`.
+
+		This function is identical to ``datastore.RunInTransactionOptions``, except that the query cache
+		of the kinds written inside the transaction is invalidated after it has been committed
+		(see :func:`server.db.invalidateQueryCache`).
+
+		:returns: The return value of *function*.
+
+		:raises: :exc:`TransactionFailedError`, if the transaction could not be committed.
+	"""
+	if getattr( _txnState, "kinds", None ) is not None or datastore.IsInTransaction():
+		# Nested call; the outermost transaction invalidates everything once it has been committed
+		return( datastore.RunInTransactionOptions( options, function, *args, **kwargs ) )
+	_txnState.kinds = set()
+	try:
+		res = datastore.RunInTransactionOptions( options, function, *args, **kwargs )
+		kinds = _txnState.kinds
+	finally:
+		_txnState.kinds = None
+	_invalidateQueryCacheForKinds( kinds )
+	return( res )
+
+def RunInTransaction( function, *args, **kwargs ):
+	"""
+		Runs *function* in a transaction, see :func:`server.db.RunInTransactionOptions`.
+	"""
+	return( RunInTransactionOptions( None, function, *args, **kwargs ) )
+
+def RunInTransactionCustomRetries( retries, function, *args, **kwargs ):
+	"""
+		Runs *function* in a transaction, retrying it up to *retries* times,
+		see :func:`server.db.RunInTransactionOptions`.
+	"""
+	return( RunInTransactionOptions( TransactionOptions( retries=retries ), function, *args, **kwargs ) )
 
 
 class Query( object ):
@@ -288,10 +682,17 @@ class Query( object ):
 		self._filterHook = None
 		self._orderHook = None
 		self._origCursor = None
+		self._origEndCursor = None
+		self._projection = None # Properties to fetch, if this is a projection query
+		self._subset = None # Bones fetch() will unserialize (all if None)
+		self._cachedCursor = __undefinedC__ # Cursor of the last run, if that result has been served from the query cache
 		self._customMultiQueryMerge = None # Sometimes, the default merge functionality from MultiQuery is not sufficient
 		self._calculateInternalMultiQueryAmount = None # Some (Multi-)Queries need a different amount of results per subQuery than actually returned
 		self.customQueryInfo = {} # Allow carrying custom data along with the query. Currently only used by spartialBone to record the guranteed correctnes
 		self.origKind = kind
+		self._kind = kind # Kind actually queried (see setKind)
+		self._orderings = () # Orderings applied by the last call to order()
+		self._ancestor = None # Ancestor set by ancestor()
 
 	def setFilterHook(self, hook):
 		"""
@@ -556,6 +957,7 @@ class Query( object ):
 		if self.datastoreQuery is None:
 			return
 		self.datastoreQuery.Order( *orderings )
+		self._orderings = tuple( orderings )
 		return( self )
 
 	def ancestor(self, ancestor):
@@ -576,6 +978,7 @@ class Query( object ):
 			:rtype: server.db.Query
 		"""
 		self.datastoreQuery.Ancestor( ancestor )
+		self._ancestor = str( ancestor.key() if isinstance( ancestor, datastore.Entity ) else ancestor )
 		return( self )
 
 	def cursor( self, cursor, endCursor=None ):
@@ -615,6 +1018,7 @@ class Query( object ):
 											end_cursor=endCursor or qo.end_cursor,
 											projection=qo.projection )
 		self._origCursor = cursor
+		self._origEndCursor = endCursor
 		return( self )
 
 	def limit( self, amount ):
@@ -632,6 +1036,60 @@ class Query( object ):
 		self.amount = amount
 		return self
 
+	def projection( self, *properties ):
+		"""
+			Turns this query into a projection query.
+
+			Only the given properties are read (directly from the index) and the resulting
+			entities contain nothing else. This is much cheaper for listings that only
+			show a few columns of a wide entity. If this query has been created using
+			:func:`server.skeleton.Skeleton.all`, :func:`server.db.Query.fetch` will only fill
+			the bones belonging to these properties.
+
+			The datastore imposes some restrictions on projection queries: All properties
+			must be indexed, they can't be used in an equality filter and an entity is
+			returned once for each value of a multi-valued property.
+
+			:param properties: Names of the properties to fetch. If none are given, \
+			projection is disabled again.
+			:type properties: str
+
+			:returns: Returns the query itself for chaining.
+			:rtype: server.db.Query
+		"""
+		self._projection = tuple( properties ) or None
+		return( self )
+
+	def subset( self, *boneNames ):
+		"""
+			Restricts :func:`server.db.Query.fetch` to unserialize only the given bones.
+
+			Unlike :func:`server.db.Query.projection`, the query is still run keys-only and full
+			entities are fetched by key (so they can be served from cache), but all other bones
+			of the resulting skeletons are left empty. This saves the cost of unserializing
+			expensive bones (like relations) that a listing doesn't display.
+
+			:param boneNames: Names of the bones to unserialize. If none are given, \
+			all bones are unserialized again.
+			:type boneNames: str
+
+			:returns: Returns the query itself for chaining.
+			:rtype: server.db.Query
+		"""
+		self._subset = tuple( boneNames ) or None
+		return( self )
+
+	def _getFetchedBoneNames(self):
+		"""
+			Returns the list of bones :func:`server.db.Query.fetch` will unserialize,
+			or None if all bones are unserialized.
+		"""
+		if self._subset:
+			return( list( self._subset ) )
+		if self._projection:
+			return( list( set( [ x.split(".")[0] for x in self._projection ] ) ) )
+		return( None )
+
 	def isKeysOnly(self):
 		"""
 			Returns True if this query is configured as *keys only*, False otherwise.
@@ -721,7 +1179,10 @@ class Query( object ):
 		"""
 		if self.datastoreQuery is None:
 			return( None )
-
+		if self._cachedCursor is not __undefinedC__: #The last run has been served from the query cache
+			if self._cachedCursor is None:
+				return( None )
+			return( datastore_query.Cursor( urlsafe=self._cachedCursor ) )
 		return( self.datastoreQuery.GetCursor() )
 
 	def getKind(self):
@@ -744,6 +1205,7 @@ class Query( object ):
 		if self.datastoreQuery is None:
 			return
 		self.datastoreQuery.__kind = newKind
+		self._kind = newKind
 
 	def getAncestor(self):
 		"""
@@ -782,6 +1244,18 @@ class Query( object ):
 			return( None )
 		origLimit = limit if limit!=-1 else self.amount
 		kwargs["limit"] = origLimit
+		_trackDependencies( kinds=[ self.origKind ] )
+		self._cachedCursor = __undefinedC__
+		queryCacheKey = self._getQueryCacheKey( kwargs )
+		if queryCacheKey:
+			cacheRes = memcache.get( queryCacheKey, namespace=__QueryCacheKeyPrefix__ )
+			if cacheRes is not None:
+				keyList, self._cachedCursor = cacheRes
+				if conf["viur.debug.traceQueries"]:
+					logging.debug("Served query on %s with filter %s and orders %s from cache. Returned %s results" % (self.getKind(), self.getFilter(), self.getOrders(), len(keyList)))
+				if keysOnly:
+					return( keyList )
+				return( [ x for x in Get( keyList ) if x is not None ] )
 		if not isinstance( self.datastoreQuery, datastore.MultiQuery ):
 			internalKeysOnly = True
 		else:
@@ -789,6 +1263,10 @@ class Query( object ):
 		if conf["viur.db.caching" ]<2:
 			# Query-Caching is disabled, make this query keys-only if (and only if) explicitly requested for this query
 			internalKeysOnly = keysOnly
+		if self._projection and not keysOnly:
+			# Projections are read from the index directly - fetching them by key would defeat their purpose
+			kwargs["projection"] = self._projection
+			internalKeysOnly = False
 		if self._customMultiQueryMerge:
 			# We do a really dirty trick here: Running the queries in our MultiQuery by hand, as
 			# we don't want the default sort&merge functionality from :class:`google.appengine.api.datastore.MultiQuery`
@@ -796,6 +1274,11 @@ class Query( object ):
 			res = []
 			if self._calculateInternalMultiQueryAmount:
 				kwargs["limit"] = self._calculateInternalMultiQueryAmount(kwargs["limit"])
+			# Each Run() dispatches its first batch asynchronously. Request all results within that
+			# first batch, so all subqueries are in flight at once and none of them needs a second round trip
+			if kwargs["limit"]:
+				kwargs.setdefault( "batch_size", kwargs["limit"] )
+				kwargs.setdefault( "prefetch_size", kwargs["limit"] )
 			for qry in getattr(self.datastoreQuery,"_MultiQuery__bound_queries"):
 				res.append( qry.Run( keys_only=internalKeysOnly, **kwargs ) )
 			# As the results are now available, perform the actual merge
@@ -811,25 +1294,68 @@ class Query( object ):
 			if len(res)>0 and res[0].key().kind()!=self.origKind and res[0].key().parent().kind()==self.origKind:
 				#Fixing the kind - it has been changed (probably by quering an relation)
 				res = [ x.key().parent() for x in res ]
-			if res and isinstance(res[0], datastore_types.Key):
-				return res
-			else:
-				return( [x.key() for x in res] )
+			if not res or not isinstance(res[0], datastore_types.Key):
+				res = [x.key() for x in res]
 		elif keysOnly and internalKeysOnly: #Keys-only requested and we did it
 			if len(res)>0 and res[0].kind()!=self.origKind and res[0].parent().kind()==self.origKind:
 				#Fixing the kind - it has been changed (probably by quering an relation)
 				res = [ x.parent() for x in res ]
-			return( res )
 		elif not keysOnly and not internalKeysOnly: #Full query requested and we did it
 			if len(res)>0 and res[0].key().kind()!=self.origKind and res[0].key().parent().kind()==self.origKind:
 				#Fixing the kind - it has been changed (probably by quering an relation)
-				res = Get( [ x.key().parent() for x in res ] )
-			return( res )
+				res = [ x for x in Get( [ x.key().parent() for x in res ] ) if x is not None ]
 		else: #Well.. Full results requested, but we did keys-only
 			if len(res)>0 and res[0].kind()!=self.origKind and res[0].parent().kind()==self.origKind:
 				#Fixing the kind - it has been changed (probably by quering an relation)
 				res = [ x.parent() for x in res ]
-			return( Get( res ) )
+			res = [ x for x in Get( res ) if x is not None ] #Entities deleted since the (eventually consistent) query ran
+		if queryCacheKey:
+			self._storeQueryCacheResult( queryCacheKey, res, keysOnly )
+		return( res )
+
+	def _getQueryCacheKey(self, kwargs):
+		"""
+			Returns the memcache key the results of this query are cached under,
+			or None if this query can't be served from the query cache.
+
+			Only queries created by :func:`server.skeleton.Skeleton.all` are cached, as only writes
+			performed by :func:`server.skeleton.Skeleton.toDB` and :func:`server.skeleton.Skeleton.delete`
+			invalidate that cache (see :func:`server.db.invalidateQueryCache`).
+		"""
+		if not conf["viur.db.queryCache"] or conf["viur.db.caching"] < 1 or self.srcSkel is None \
+				or self._customMultiQueryMerge or self._projection or datastore.IsInTransaction():
+			return( None )
+		generations = _getKindGenerations( [ self.origKind, self._kind ] )
+		if generations is None: #Memcache unavailable
+			return( None )
+		filters = self.getFilter()
+		if isinstance( filters, list ): #MultiQuery
+			filters = [ sorted( x.items() ) for x in filters ]
+		else:
+			filters = sorted( filters.items() )
+		fingerprint = [ generations, self.origKind, self._kind, filters, self._orderings, self._ancestor,
+				sorted( kwargs.items() ),
+				self._origCursor.urlsafe() if self._origCursor else None,
+				self._origEndCursor.urlsafe() if self._origEndCursor else None ]
+		return( sha256( repr( fingerprint ) ).hexdigest() )
+
+	def _storeQueryCacheResult(self, queryCacheKey, res, keysOnly):
+		"""
+			Stores the keys of *res* (together with the current cursor) in the query cache.
+		"""
+		if keysOnly:
+			keyList = res
+		else:
+			keyList = [ x.key() for x in res if x is not None ]
+		try:
+			cursor = self.datastoreQuery.GetCursor()
+			cursor = cursor.urlsafe() if cursor else None
+		except AssertionError: #No Cursors available on MultiQueries ( in or != )
+			cursor = None
+		try:
+			memcache.set( queryCacheKey, ( keyList, cursor ), time=__cacheTime__, namespace=__QueryCacheKeyPrefix__ )
+		except:
+			pass
 
 	def fetch(self, limit=-1, **kwargs ):
 		"""
@@ -863,14 +1389,21 @@ class Query( object ):
 		res.customQueryInfo = self.customQueryInfo
 		if dbRes is None:
 			return( res )
+		boneNames = self._getFetchedBoneNames()
+		t1 = time()
 		for e in dbRes:
 			#s = self.srcSkel.clone()
 			valueCache = {}
 			self.srcSkel.setValuesCache(valueCache)
-			self.srcSkel.setValues(e)
+			if boneNames is None:
+				self.srcSkel.setValues(e)
+			else:
+				self.srcSkel.setValues(e, boneNames=boneNames)
 			res.append( self.srcSkel.getValuesCache() )
+		if conf["viur.debug.traceQueries"]:
+			logging.debug("Unserialized %s entries of %s (%s bones each) in %.2f ms" % (len(res), self.origKind, len(boneNames) if boneNames is not None else "all", (time()-t1)*1000))
 		try:
-			c = self.datastoreQuery.GetCursor()
+			c = self.getCursor()
 			if c:
 				res.cursor = c.urlsafe()
 			else:
@@ -900,6 +1433,7 @@ class Query( object ):
 		"""
 		if self.datastoreQuery is None: #Noting to pull here
 			raise StopIteration()
+		_trackDependencies( kinds=[ self.origKind ] )
 		if isinstance( self.datastoreQuery, datastore.MultiQuery ) and keysOnly:
 			# Wanted KeysOnly, but MultiQuery is unable to give us that.
 			for res in self.datastoreQuery.Run():
@@ -1003,6 +1537,8 @@ class Query( object ):
 			res.order( orders[0] )
 		elif len( orders ) > 1:
 			res.order( tuple( orders ) )
+		res._projection = self._projection
+		res._subset = self._subset
 		return( res )
 
 
@@ -1124,9 +1660,6 @@ class Entity( datastore.Entity ):
 
 AllocateIdsAsync = datastore.AllocateIdsAsync
 AllocateIds = datastore.AllocateIds
-RunInTransaction = datastore.RunInTransaction
-RunInTransactionCustomRetries = datastore.RunInTransactionCustomRetries
-RunInTransactionOptions = datastore.RunInTransactionOptions
 TransactionOptions = datastore_rpc.TransactionOptions
 
 Key = datastore_types.Key
@@ -1164,4 +1697,5 @@ DESCENDING = datastore_query.PropertyOrder.DESCENDING
 __all__ = [	PutAsync, Put, GetAsync, Get, DeleteAsync, Delete, AllocateIdsAsync, AllocateIds, RunInTransaction, RunInTransactionCustomRetries, RunInTransactionOptions, TransactionOptions,
 		Error, BadValueError, BadPropertyError, BadRequestError, EntityNotFoundError, BadArgumentError, QueryNotFoundError, TransactionNotFoundError, Rollback,
 		TransactionFailedError, BadFilterError, BadQueryError, BadKeyError, BadKeyError, InternalError, NeedIndexError, ReferencePropertyResolveError, Timeout,
-		CommittedButStillApplying, Entity, Query, DatastoreQuery, MultiQuery, Cursor, KEY_SPECIAL_PROPERTY, ASCENDING, DESCENDING, IsInTransaction ]
+		CommittedButStillApplying, Entity, Query, DatastoreQuery, MultiQuery, Cursor, KEY_SPECIAL_PROPERTY, ASCENDING, DESCENDING, IsInTransaction,
+		getCacheStats, resetCacheStats, flushLocalCache, invalidateQueryCache, startDependencyTracking, stopDependencyTracking ]
@@ -41,6 +41,15 @@ class Redirect( HTTPException ):
 		super( Redirect, self ).__init__(  status=303, name = "Redirect", descr=descr )
 		self.url = url
 
+class NotModified( HTTPException ):
+	"""
+		Causes an 304 - Not Modified response (without body), as the client's cached copy is still valid.
+
+		Raised by :func:`server.BrowseHandler.checkNotModified`.
+	"""
+	def __init__( self, descr="Not Modified" ):
+		super( NotModified, self ).__init__(  status=304, name = "Not Modified", descr=descr )
+
 class Unauthorized( HTTPException ):
 	"""
 		Unauthorized
@@ -135,6 +144,15 @@ class RequestTooLarge( HTTPException ):
 	def __init__( self, descr="Request Too Large" ):
 		super( RequestTooLarge, self ).__init__(  status=413, name = "Request Too Large", descr=descr )
 
+class TooManyRequests( HTTPException ):
+	"""
+		TooManyRequests
+
+		Raised if the rate limit of a function (see :func:`server.rateLimited`) has been exceeded.
+	"""
+	def __init__( self, descr="Too Many Requests" ):
+		super( TooManyRequests, self ).__init__(  status=429, name = "Too Many Requests", descr=descr )
+
 class Censored( HTTPException ):
 	"""
 		Censored
@@ -68,8 +68,8 @@ class fileBaseSkel(TreeLeafSkel):
 				self["mimetype"] = self["metamime"]
 		return r
 
-	def setValues(self, values):
-		r = super(fileBaseSkel, self).setValues(values)
+	def setValues(self, values, *args, **kwargs):
+		r = super(fileBaseSkel, self).setValues(values, *args, **kwargs)
 		if not self["mimetype"]:
 			if self["meta_mime"]:
 				self["mimetype"] = self["meta_mime"]
@@ -1,7 +1,34 @@
 # -*- coding: utf-8 -*-
 from google.appengine.api import memcache
 from server import request, utils
-from datetime import datetime
+from server.session import current as currentSession
+from time import time
+from hashlib import sha1
+
+__memcacheNamespace__ = "viur-ratelimit"
+__stateTTL__ = 24*60*60 # How long (seconds) memcache keeps the state of an actor after it's been reset
+__localCacheTime__ = 1000 # How long (ms) an instance trusts its local copy of an actor's state if it said "available"
+__localCacheSize__ = 10000
+
+_localState = {} # (resource, endpoint) -> (theoretical arrival time, when we've learned it) in ms
+_stats = {"checks": 0, "checkRPCs": 0, "decrements": 0, "decrementRPCs": 0}
+
+
+def getStats():
+	"""
+		Returns how many quota checks and decrements have been made since the instance started
+		(or :func:`server.ratelimit.resetStats` has been called), and how many memcache calls they needed.
+
+		:rtype: dict
+	"""
+	return( dict( _stats ) )
+
+def resetStats():
+	"""
+		Resets the counters returned by :func:`server.ratelimit.getStats`.
+	"""
+	for k in _stats.keys():
+		_stats[ k ] = 0
 
 
 class RateLimit(object):
@@ -13,6 +40,11 @@ class RateLimit(object):
 		isQuotaAvailable before executing the action to check if there is quota available and
 		after executing the action decrementQuota.
 
+		Its implemented as token bucket (using the generic cell rate algorithm): Each actor has a bucket
+		of *maxRate* tokens, refilled continuously within *minutes*. Its state is a single memcache
+		counter (the time its bucket will be full again), so decrementQuota is one memcache incr.
+		Each instance remembers the last state it has seen, so isQuotaAvailable doesn't need to ask
+		memcache while an actor is known to be out of quota (or has been seen recently).
 	"""
 
 	def __init__(self, resource, maxRate, minutes, method):
@@ -24,61 +56,72 @@ class RateLimit(object):
 		:type maxRate: int
 		:param minutes: Length of the time-span in minutes
 		:type minutes: int
-		:param method: Lock by IP or by the current user
-		:type method: 'ip' | 'user'
+		:param method: Lock by IP, by the current user or by the current session (guests and requests
+			without a session cookie are locked by their IP)
+		:type method: 'ip' | 'user' | 'session'
 		"""
 		super(RateLimit, self).__init__()
 		self.resource = resource
 		self.maxRate = maxRate
 		self.minutes = minutes
-		self.steps = min(minutes, 5)
-		self.secondsPerStep = 60*(float(minutes)/float(self.steps))
-		assert method in ["ip", "user"], "method must be 'ip' or 'user'"
+		self.burst = minutes*60*1000 # Capacity of the bucket in ms
+		self.interval = max(self.burst//maxRate, 1) # Each call consumes that many ms
+		assert method in ["ip", "user", "session"], "method must be 'ip', 'user' or 'session'"
+		self.method = method
 		self.useUser = method == "user"
 
 	def _getEndpointKey(self):
 		"""
-		:warning:
-			It's invalid to call _getEndpointKey if method is set to user and there's no user logged in!
-
-		:return: the key associated with the current endpoint (it's IP or the key of the current user)
+		:return: the key associated with the current endpoint (it's IP, the key of the current user or its session)
 		"""
 		if self.useUser:
 			user = utils.getCurrentUser()
-			assert user, "Cannot decrement usage from guest!"
-			return user["key"]
-		else:
-			remoteAddr = request.current.get().request.remote_addr
-			if "::" in remoteAddr:  # IPv6 in shorted form
-				remoteAddr = remoteAddr.split(":")
-				blankIndex  = remoteAddr.index("")
-				missigParts = ["0000"] * (8 - len(remoteAddr))
-				remoteAddr = remoteAddr[:blankIndex] + missigParts + remoteAddr[blankIndex + 1:]
-				return ":".join(remoteAddr[:4])
-			elif ":" in remoteAddr:  # It's IPv6, so we remove the last 64 bits (interface id)
-				# as it is easily controlled by the user
-				return ":".join(remoteAddr.split(":")[4:])
-			else:  # It's IPv4, simply return that address
-				return remoteAddr
-
-
-	def _getCurrentTimeKey(self):
+			if user:
+				return user["key"]
+		elif self.method == "session":
+			# Only sessions the client presented a valid cookie for; otherwise each made-up cookie would get its own quota
+			sessionKey = currentSession.getValidatedSessionKey()
+			if sessionKey:
+				return "session-%s" % sha1(sessionKey).hexdigest()
+		# Guests and clients without a (valid) session are locked by their IP
+		remoteAddr = request.current.get().request.remote_addr
+		if "::" in remoteAddr:  # IPv6 in shorted form
+			remoteAddr = remoteAddr.split(":")
+			blankIndex  = remoteAddr.index("")
+			missigParts = ["0000"] * (8 - len(remoteAddr))
+			remoteAddr = remoteAddr[:blankIndex] + missigParts + remoteAddr[blankIndex + 1:]
+			return ":".join(remoteAddr[:4])
+		elif ":" in remoteAddr:  # It's IPv6, so we remove the last 64 bits (interface id)
+			# as it is easily controlled by the user
+			return ":".join(remoteAddr.split(":")[4:])
+		else:  # It's IPv4, simply return that address
+			return remoteAddr
+
+
+	def _getMemcacheKey(self, endPoint):
 		"""
-		:return: the current lockperiod used in second position of the memcache key
+		:return: The memcache key holding the state of *endPoint*
 		"""
-		dateTime = datetime.now()
-		key = dateTime.strftime("%Y-%m-%d-%%s")
-		secsinceMidnight = (dateTime - dateTime.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
-		currentStep = int(secsinceMidnight/self.secondsPerStep)
-		return key % currentStep
+		return "%s-%s" % (self.resource, endPoint)
 
 	def decrementQuota(self):
 		"""
 		Removes one attempt from the pool of available Quota for that user/ip
 		"""
-		memcacheKey = "%s-%s-%s" % (self.resource, self._getEndpointKey(), self._getCurrentTimeKey())
-		if memcache.incr(memcacheKey) is None:
-			memcache.set(memcacheKey, 1, 2*60*self.minutes)
+		endPoint = self._getEndpointKey()
+		memcacheKey = self._getMemcacheKey(endPoint)
+		now = int(time()*1000)
+		_stats["decrements"] += 1
+		_stats["decrementRPCs"] += 1
+		tat = memcache.incr(memcacheKey, self.interval, namespace=__memcacheNamespace__)
+		if tat is None or tat-self.interval < now:
+			# There's no state (yet) or the bucket has been full already; start again from now
+			tat = now+self.interval
+			_stats["decrementRPCs"] += 1
+			memcache.set(memcacheKey, tat, __stateTTL__, namespace=__memcacheNamespace__)
+		if len(_localState) > __localCacheSize__:
+			_localState.clear()
+		_localState[(self.resource, endPoint)] = (tat, now)
 
 	def isQuotaAvailable(self):
 		"""
@@ -87,13 +130,19 @@ class RateLimit(object):
 		:rtype: bool
 		"""
 		endPoint = self._getEndpointKey()
-		dateTime = datetime.now()
-		secSinceMidnight = (dateTime - dateTime.replace(hour=0, minute=0, second=0, microsecond=0)).total_seconds()
-		currentStep = int(secSinceMidnight/self.secondsPerStep)
-		keyBase = dateTime.strftime("%Y-%m-%d-%%s")
-		memcacheKeys = []
-		for x in range(0, self.steps):
-			memcacheKeys.append("%s-%s-%s" % (self.resource, endPoint, keyBase % (currentStep - x)))
-		tmpRes = memcache.get_multi(memcacheKeys)
-		return sum(tmpRes.values()) <= self.maxRate
-
+		now = int(time()*1000)
+		_stats["checks"] += 1
+		localState = _localState.get((self.resource, endPoint))
+		if localState:
+			tat, seen = localState
+			if tat-now > self.burst-self.interval:
+				# Its state can only have grown since, so its still out of quota
+				return False
+			if now-seen < __localCacheTime__:
+				return True
+		_stats["checkRPCs"] += 1
+		tat = memcache.get(self._getMemcacheKey(endPoint), namespace=__memcacheNamespace__) or now
+		if len(_localState) > __localCacheSize__:
+			_localState.clear()
+		_localState[(self.resource, endPoint)] = (tat, now)
+		return tat-now <= self.burst-self.interval
@@ -2,7 +2,7 @@
 import utils as jinjaUtils
 from wrap import ListWrapper, SkelListWrapper
 
-from server import utils, request, errors, securitykey
+from server import utils, request, errors, securitykey, conf
 from server.skeleton import Skeleton, BaseSkeleton, RefSkel, skeletonByKind
 from server.bones import *
 
@@ -634,6 +634,13 @@ class Render( object ):
 			:return: Returns the emitted HTML response.
 			:rtype: str
 		"""
+		if conf["viur.conditionalRequests.useChangedate"] and isinstance( skel, Skeleton ) \
+				and isinstance( dict( skel.items() ).get( "changedate" ), dateBone ) and skel["changedate"]:
+			# The client may already have this entry; don't render it again in that case.
+			# The valuesCache holds changedate in the requester's local time, so convert it back to UTC first.
+			lastModified = dict( skel.items() )[ "changedate" ].readLocalized( skel["changedate"] )
+			request.current.get().checkNotModified( lastModified=lastModified )
+
 		if not tpl and "viewTemplate" in dir( self.parent ):
 			tpl = self.parent.viewTemplate
 
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 import json
 from collections import OrderedDict
-from server import errors, request, bones
-from server.skeleton import RefSkel, skeletonByKind
+from server import errors, request, bones, conf
+from server.skeleton import Skeleton, RefSkel, skeletonByKind
 import logging
 
 class DefaultRender(object):
@@ -224,6 +224,11 @@ class DefaultRender(object):
 		return json.dumps(res)
 
 	def view(self, skel, action="view", params = None, *args, **kwargs):
+		if conf["viur.conditionalRequests.useChangedate"] and isinstance(skel, Skeleton) \
+				and isinstance(dict(skel.items()).get("changedate"), bones.dateBone) and skel["changedate"]:
+			# The valuesCache holds changedate in the requester's local time, so convert it back to UTC first
+			lastModified = dict(skel.items())["changedate"].readLocalized(skel["changedate"])
+			request.current.get().checkNotModified(lastModified=lastModified)
 		return self.renderEntry(skel, action, params)
 
 	def add(self, skel, action = "add", params = None, **kwargs):
@@ -8,17 +8,27 @@
 
 	Its also possible to store data along with a securityKey and specify a lifeTime.
 
+	If conf["viur.securityKey.signed"] is set, keys without data aren't stored in the datastore anymore.
+	Instead, they're HMAC-signed tokens carrying their expiration date (and are bound to the current session
+	unless a duration has been given). Unless conf["viur.securityKey.replayProtection"] is disabled, used tokens
+	are remembered in memcache, so they can't be used twice.
 """
 
 
 from datetime import datetime, timedelta
-from server.utils import generateRandomString
+from time import time
+import hmac, hashlib
+from server.utils import generateRandomString, getSecret, safeStringComparison
 from server.session import current as currentSession
 from server import db, conf
 from server.tasks import PeriodicTask, callDeferred
+from google.appengine.api import memcache
+import logging
 
 
 securityKeyKindName = "viur-securitykeys"
+__clearSKeysBatchSize__ = 500
+__remainingCountLimit__ = 1000
 
 def create( duration=None, **kwargs ):
 	"""
@@ -38,6 +48,8 @@ def create( duration=None, **kwargs ):
 	else:
 		sessionDependend = False
 		duration = int( duration )
+	if conf["viur.securityKey.signed"] and not kwargs:
+		return( createSignedKey( key, int( time() )+duration, sessionDependend ) )
 	dbObj = db.Entity(securityKeyKindName, name=key )
 	for k, v in kwargs.items():
 		dbObj[ k ] = v
@@ -63,6 +75,8 @@ def validate( key, acceptSessionKey=False ):
 	if acceptSessionKey:
 		if key==currentSession.getSessionSecurityKey():
 			return( True )
+	if key and "." in key:
+		return( validateSignedKey( key ) )
 	try:
 		dbObj = db.Get( db.Key.from_path( securityKeyKindName, key ) )
 	except:
@@ -84,6 +98,67 @@ def validate( key, acceptSessionKey=False ):
 		return( res )
 	return( False )
 
+def getSessionBinding( create=False ):
+	"""
+		Returns the value session-bound signed keys are bound to (the session's security key).
+
+		:param create: Initialize the session if it doesn't have a security key yet
+		:type create: bool
+		:returns: str (empty if there's no such key)
+	"""
+	binding = currentSession.getSessionSecurityKey()
+	if not binding and create:
+		currentSession.getSessionKey()
+		binding = currentSession.getSessionSecurityKey()
+	return( binding or "" )
+
+def signKey( nonce, until, binding ):
+	"""
+		Computes the signature of a signed key.
+	"""
+	# hmac requires byte strings; the binding (and possibly the secret) are read from the datastore as unicode
+	msg = ( "%s|%s|%s" % ( nonce, until, binding ) ).encode( "UTF-8" )
+	return( hmac.new( str( getSecret( "securitykey" ) ), msg, hashlib.sha256 ).hexdigest() )
+
+def createSignedKey( nonce, until, sessionDependend ):
+	"""
+		Creates a signed key (see :func:`create`), which is valid until the unix-timestamp *until*.
+
+		:returns: The new key in the form nonce.until.(s|g).signature
+	"""
+	binding = getSessionBinding( create=True ) if sessionDependend else ""
+	scope = "s" if sessionDependend else "g"
+	return( "%s.%s.%s.%s" % ( nonce, until, scope, signKey( nonce, until, binding ) ) )
+
+def validateSignedKey( key ):
+	"""
+		Validates a key created by :func:`createSignedKey`.
+
+		:returns: True if its valid, False otherwise
+	"""
+	try:
+		nonce, until, scope, signature = str( key ).split(".")
+		until = int( until )
+	except (ValueError, UnicodeEncodeError):
+		return( False )
+	if scope == "s":
+		binding = getSessionBinding()
+		if not binding:
+			return( False )
+	elif scope == "g":
+		binding = ""
+	else:
+		return( False )
+	if not safeStringComparison( signKey( nonce, until, binding ), signature ):
+		return( False )
+	if until < time(): #This key has expired
+		return( False )
+	if conf["viur.securityKey.replayProtection"]:
+		if not memcache.add( nonce, True, time=max( int( until-time() ), 1 ), namespace=securityKeyKindName ):
+			# Its been used before (or memcache is unavailable)
+			return( False )
+	return( True )
+
 @PeriodicTask(60*4)
 def startClearSKeys():
 	"""
@@ -92,13 +167,28 @@ def startClearSKeys():
 	doClearSKeys( (datetime.now()-timedelta(seconds=300)).strftime("%d.%m.%Y %H:%M:%S"), None )
 
 @callDeferred
-def doClearSKeys( timeStamp, cursor ):
-	gotAtLeastOne = False
+def doClearSKeys( timeStamp, cursor, deletedCount=0 ):
+	"""
+		Deletes security keys expired before *timeStamp* in keys-only batches of __clearSKeysBatchSize__
+		(one multi-delete each). Each batch schedules the next one; the last one logs how many keys
+		have been removed and how many remain.
+
+		:param timeStamp: Keys expired before this date are deleted (%d.%m.%Y %H:%M:%S)
+		:type timeStamp: str
+		:param cursor: Internal; The cursor to continue from
+		:param deletedCount: Internal; How many keys the previous batches have removed
+	"""
 	query = db.Query( securityKeyKindName ).filter( "until <", datetime.strptime(timeStamp,"%d.%m.%Y %H:%M:%S") )
-	for oldKey in query.run(100, keysOnly=True):
-		gotAtLeastOne = True
-		db.Delete( oldKey )
-	newCursor = query.getCursor()
-	if gotAtLeastOne and newCursor and newCursor.urlsafe()!=cursor:
-		doClearSKeys( timeStamp, newCursor.urlsafe() )
+	if cursor:
+		query.cursor( cursor )
+	keys = query.run( __clearSKeysBatchSize__, keysOnly=True )
+	if keys:
+		db.Delete( keys )
+	deletedCount += len( keys )
+	if len( keys ) == __clearSKeysBatchSize__:
+		logging.info( "Clearing expired security keys: %s removed so far" % deletedCount )
+		doClearSKeys( timeStamp, query.getCursor().urlsafe(), deletedCount )
+	else:
+		remaining = db.Query( securityKeyKindName ).count( limit=__remainingCountLimit__ )
+		logging.info( "Cleared %s expired security keys, %s%s keys remaining" % ( deletedCount, remaining, "+" if remaining >= __remainingCountLimit__ else "" ) )
 
@@ -1,14 +1,23 @@
 # -*- coding: utf-8 -*-
 import threading
-import json, pickle
+import json, pickle, marshal
 import base64
 import string, random
+import hmac, hashlib, zlib, os
 from time import time
+from datetime import datetime, date
 from server.tasks import PeriodicTask, callDeferred
-from server import db
+from server import db, utils
 from server.config import conf
+from google.appengine.api import memcache
+from google.appengine.api.datastore_types import Blob
 from google.appengine.runtime.apiproxy_errors import CapabilityDisabledError, OverQuotaError
 import logging
+try:
+	from Crypto.Cipher import AES
+	from Crypto.Util import Counter
+except ImportError:
+	AES = None
 
 """
 	Provides a fast and reliable session implementation for the Google AppEngine™.
@@ -27,17 +36,187 @@ import logging
 	It returns None instead of raising an Exception if the key is not found.
 """
 
+__clearSessionsMinBatchSize__ = 100
+__clearSessionsMaxBatchSize__ = 1000
+__codecMarker__ = "\x00" # Data serialized by encodeSessionData starts with this byte (legacy sessions are base64)
+__compressThreshold__ = 512 # Serialized sessions larger than this (bytes) are compressed
+__dateTag__ = "__viur_date__"
+__marshalTypes__ = ( type( None ), bool, int, long, float, str, unicode ) # Types marshal restores exactly
+
+_sizeStats = {"encoded": 0, "totalBytes": 0, "maxBytes": 0, "overBudget": 0, "pickled": 0, "legacyDecoded": 0}
+
+
+def _checkMarshalTypes( value ):
+	"""
+		Checks if *value* consists only of builtin types marshal restores exactly (no subclasses,
+		marshal writes unicode-subclasses like db.Text as raw buffer and rejects others).
+
+		:returns: None if *value* can't be marshalled, True if it contains datetime or date
+			objects (which must be tagged first), False otherwise.
+	"""
+	valueType = type( value )
+	if valueType in __marshalTypes__:
+		return( False )
+	elif valueType is datetime:
+		return( True if value.tzinfo is None else None )
+	elif valueType is date:
+		return( True )
+	elif valueType is dict:
+		items = value.keys() + value.values()
+	elif valueType in ( list, tuple, set, frozenset ):
+		items = value
+	else:
+		return( None )
+	hasDates = False
+	for item in items:
+		res = _checkMarshalTypes( item )
+		if res is None:
+			return( None )
+		hasDates = hasDates or res
+	return( hasDates )
+
+def _tagDates( value ):
+	"""
+		Replaces datetime and date objects inside *value* by tagged tuples marshal can serialize.
+	"""
+	if type( value ) is datetime:
+		return( ( __dateTag__, "datetime", value.timetuple()[ :6 ]+( value.microsecond, ) ) )
+	elif type( value ) is date:
+		return( ( __dateTag__, "date", value.timetuple()[ :3 ] ) )
+	elif type( value ) is dict:
+		return( { _tagDates( k ): _tagDates( v ) for k, v in value.items() } )
+	elif type( value ) in [ list, tuple, set, frozenset ]:
+		return( type( value )( [ _tagDates( x ) for x in value ] ) )
+	return( value )
+
+def _untagDates( value ):
+	"""
+		Reverses :func:`_tagDates`.
+	"""
+	if type( value ) is tuple and len( value ) == 3 and value[ 0 ] == __dateTag__:
+		return( datetime( *value[ 2 ] ) if value[ 1 ] == "datetime" else date( *value[ 2 ] ) )
+	elif type( value ) is dict:
+		return( { _untagDates( k ): _untagDates( v ) for k, v in value.items() } )
+	elif type( value ) in [ list, tuple, set, frozenset ]:
+		return( type( value )( [ _untagDates( x ) for x in value ] ) )
+	return( value )
+
+def encodeSessionData( data, allowPickle=True ):
+	"""
+		Serializes the session-data *data*.
+
+		Data consisting only of builtin types (and naive datetime and date objects) is serialized using
+		marshal, which is compact, fast and cannot construct arbitrary objects. Anything else, including
+		subclasses of builtin types like db.Text or OrderedDict, falls back to pickle unless *allowPickle*
+		is False. Results larger than __compressThreshold__ bytes are compressed using zlib.
+
+		:param data: The data to serialize
+		:type data: dict
+		:param allowPickle: If False, a ValueError is raised if *data* cannot be serialized without pickle
+		:type allowPickle: bool
+		:returns: str
+	"""
+	hasDates = _checkMarshalTypes( data )
+	if hasDates is None:
+		if not allowPickle:
+			raise ValueError("Session data contains types which can't be serialized without pickle")
+		fmt, payload = "p", pickle.dumps( data, protocol=pickle.HIGHEST_PROTOCOL )
+		_sizeStats[ "pickled" ] += 1
+	elif hasDates:
+		fmt, payload = "d", marshal.dumps( _tagDates( data ), 2 )
+	else:
+		fmt, payload = "m", marshal.dumps( data, 2 )
+	if len( payload ) > __compressThreshold__:
+		compressed = zlib.compress( payload )
+		if len( compressed ) < len( payload ):
+			fmt, payload = fmt.upper(), compressed
+	res = __codecMarker__ + fmt + payload
+	_sizeStats[ "encoded" ] += 1
+	_sizeStats[ "totalBytes" ] += len( res )
+	_sizeStats[ "maxBytes" ] = max( _sizeStats[ "maxBytes" ], len( res ) )
+	if len( res ) > conf[ "viur.session.sizeBudget" ]:
+		_sizeStats[ "overBudget" ] += 1
+		logging.warning( "Session exceeds its size budget (%s bytes serialized, largest keys: %s)" % ( len( res ),
+			", ".join( [ repr( k ) for k in sorted( data.keys(), key=lambda k: -len( repr( data[ k ] ) ) )[ :5 ] ] ) ) )
+	return( res )
+
+def decodeSessionData( data, allowPickle=True ):
+	"""
+		Restores session-data serialized by :func:`encodeSessionData` (or stored
+		base64-encoded by older versions of ViUR).
+
+		:param data: The serialized data
+		:type data: str
+		:param allowPickle: If False, data serialized using pickle is rejected (ValueError)
+		:type allowPickle: bool
+		:returns: dict
+	"""
+	if not data.startswith( __codecMarker__ ):
+		if not allowPickle:
+			raise ValueError("Refusing to unpickle session data")
+		_sizeStats[ "legacyDecoded" ] += 1
+		return( pickle.loads( base64.b64decode( data ) ) )
+	fmt, payload = data[ 1 ], data[ 2: ]
+	if fmt.isupper():
+		fmt, payload = fmt.lower(), zlib.decompress( payload )
+	if fmt == "m":
+		return( marshal.loads( payload ) )
+	elif fmt == "d":
+		return( _untagDates( marshal.loads( payload ) ) )
+	elif fmt == "p" and allowPickle:
+		return( pickle.loads( payload ) )
+	raise ValueError("Unknown session data format %s" % repr( fmt ) )
+
+def getSizeStats():
+	"""
+		Returns statistics about the sessions serialized since the instance started
+		(or :func:`server.session.resetSizeStats` has been called).
+
+		*encoded* is the number of sessions serialized, *totalBytes* and *maxBytes* their accumulated
+		and maximum size, *overBudget* how many exceeded conf["viur.session.sizeBudget"], *pickled* how many
+		had to fall back to pickle and *legacyDecoded* how many sessions in the old format have been read.
+
+		:rtype: dict
+	"""
+	return( dict( _sizeStats ) )
+
+def resetSizeStats():
+	"""
+		Resets the counters returned by :func:`server.session.getSizeStats`.
+	"""
+	for k in _sizeStats.keys():
+		_sizeStats[ k ] = 0
+
+
 class SessionWrapper( threading.local ):
 	cookieName = "viurCookie"
+	pendingRequest = None
 
 	def __init__( self, sessionFactory, *args, **kwargs ):
 		super( SessionWrapper, self ).__init__( *args, **kwargs )
 		self.factory = sessionFactory
 
 	def load( self, req ):
-		if not "session" in dir( self ):
-			self.session = self.factory()
-		return( self.session.load( req ) )
+		"""
+			Prepares the session for the request *req*.
+
+			The session is read from its storage on first access, so requests
+			not using it don't cause any memcache/datastore calls.
+		"""
+		if not "sessionObj" in dir( self ):
+			self.sessionObj = ( conf["viur.session.backend"] or self.factory )()
+		self.pendingRequest = req
+		return( True )
+
+	@property
+	def session( self ):
+		"""
+			The session of the current request; its loaded on first access.
+		"""
+		if self.pendingRequest is not None:
+			req, self.pendingRequest = self.pendingRequest, None
+			self.sessionObj.load( req )
+		return( self.sessionObj )
 
 	def __contains__( self, key ):
 		try:
@@ -76,6 +255,10 @@ class SessionWrapper( threading.local ):
 			pass
 
 	def save(self, req):
+		if self.pendingRequest is not None:
+			# This session hasn't been touched in this request, so there is nothing to save
+			self.pendingRequest = None
+			return( None )
 		try:
 			return( self.session.save( req ))
 		except AttributeError:
@@ -99,6 +282,19 @@ class SessionWrapper( threading.local ):
 		except AttributeError:
 			pass
 
+	def hasSessionCookie( self, req ):
+		"""
+			Checks if *req* carries a cookie of the session backend in use, so it may have a session
+			with data in it. Unlike any other method, this doesn't load the session.
+
+			:rtype: bool
+		"""
+		cookieNames = [ getattr( self.sessionObj, x ) for x in ( "plainCookieName", "signedCookieName" )
+				if hasattr( self.sessionObj, x ) ]
+		if not cookieNames: # Unknown backend; assume it has
+			return( True )
+		return( any( [ x in req.request.cookies for x in cookieNames ] ) )
+
 	def getLanguage( self ):
 		try:
 			return( self.session.get( "language" ) )
@@ -117,6 +313,17 @@ class SessionWrapper( threading.local ):
 		except AttributeError:
 			return( "" )
 
+	def getValidatedSessionKey(self):
+		"""
+			Returns an identifier of the session, if the client presented a valid cookie for an existing one.
+
+			:returns: str or None for new sessions (or if the client's cookie was invalid)
+		"""
+		try:
+			return( self.session.validatedKey )
+		except AttributeError:
+			return( None )
+
 
 	def items(self):
 		try:
@@ -130,7 +337,15 @@ class GaeSession:
 	sslCookieName = "viurSSLCookie"
 	kindName = "viur-session"
 
-	"""Store Sessions inside the Big Table/Memcache"""
+	"""
+		Store Sessions inside the Memcache/Big Table
+
+		The authoritative copy of each session lives in memcache. Changes are written through
+		to the datastore (which is only read if memcache evicted that session) if they are security
+		relevant (new session, login, logout) or if the datastore copy is older than
+		conf["viur.session.persistInterval"]. Each session carries a version, which is bumped on
+		every change of its data, so we know if the datastore copy is behind.
+	"""
 
 	def load( self, req ):
 		"""
@@ -141,23 +356,34 @@ class GaeSession:
 			will be initialized.
 		"""
 		self.changed = False
+		self.dataChanged = False
+		self.persistRequired = False
 		self.key = None
 		self.sslKey = None
 		self.sessionSecurityKey = None
 		self.session = {}
+		self.version = 0
+		self.persistedVersion = 0
+		self.persistedTime = 0
+		self.userid = None
+		self.validatedKey = None # Only set if the client presented the cookie of an existing session
 		if self.plainCookieName in req.request.cookies:
 			cookie = req.request.cookies[ self.plainCookieName ]
 			try:
-				data = db.Get( db.Key.from_path( self.kindName, cookie ) )
+				data = self.loadSessionData( str( cookie ) )
 			except:
 				return( False )
-			if data: #Loaded successfully from Memcache
+			if data: #Loaded successfully from Memcache/Datastore
 				if data["lastseen"] < time() - conf[ "viur.session.lifeTime" ]:
 					# This session is too old
 					return( False )
 
-				self.session = pickle.loads( base64.b64decode(data["data"]) )
+				self.session = decodeSessionData( data["data"] )
 				self.sslKey = data["sslkey"]
+				self.userid = data.get("user")
+				self.version = data.get("version") or 0
+				self.persistedVersion = data.get("persistedversion", self.version)
+				self.persistedTime = data.get("persistedtime", data["lastseen"])
 				if "skey" in data:
 					self.sessionSecurityKey = data["skey"]
 				else:
@@ -170,40 +396,116 @@ class GaeSession:
 				self.reset()
 				return( False )
 			self.key = str( cookie )
+			if data:
+				self.validatedKey = self.key
 			return( True )
 
+	def loadSessionData( self, key ):
+		"""
+			Fetches the stored state of the session *key*.
+
+			Memcache is asked first; the datastore is only consulted if memcache
+			doesn't know that session (anymore).
+
+			:returns: dict or None
+		"""
+		data = memcache.get( key, namespace=self.kindName )
+		if data is not None:
+			return( data )
+		dbSession = db.Get( db.Key.from_path( self.kindName, key ) )
+		if not dbSession:
+			return( None )
+		data = dict( dbSession.items() )
+		data["persistedversion"] = data.get("version") or 0
+		data["persistedtime"] = data["lastseen"]
+		try:
+			memcache.add( key, data, time=conf[ "viur.session.lifeTime" ], namespace=self.kindName )
+		except:
+			pass
+		return( data )
+
 	def save(self, req):
 		"""
 			Writes the session to the memcache/datastore.
 
 			Does nothing, if the session hasn't been changed in the current request.
+			The datastore copy is only updated if this change is security relevant or
+			if it's older than conf["viur.session.persistInterval"] (see :class:`GaeSession`).
 		"""
 		if self.changed:
-			serialized = base64.b64encode( pickle.dumps(self.session, protocol=pickle.HIGHEST_PROTOCOL ) )
+			serialized = encodeSessionData( self.session )
 			self.getSessionKey( req )
-			# Get the current user id
-			userid = None
+			userid = self.getCurrentUserId()
+			userid = str(userid) if userid else "guest" #Store the userid inside the sessionobj, so we can kill specific sessions if needed
+			if userid != self.userid:
+				# Logged in or out - killSessionByUser must see this
+				self.persistRequired = True
+			if self.dataChanged:
+				self.version += 1
+			now = time()
+			sessionData = {
+				"data": serialized,
+				"sslkey": self.sslKey,
+				"skey": self.sessionSecurityKey,
+				"lastseen": now,
+				"user": userid,
+				"version": self.version
+			}
+			persistAge = now - self.persistedTime
+			persist = self.persistRequired \
+				or ( self.version != self.persistedVersion and persistAge >= conf[ "viur.session.persistInterval" ] ) \
+				or persistAge >= conf[ "viur.session.lifeTime" ]/2 # Don't let doClearSessions remove an active session
+			if persist:
+				self.persistSessionData( sessionData )
+			sessionData["persistedversion"] = self.persistedVersion
+			sessionData["persistedtime"] = self.persistedTime
 			try:
-				if "user" in dir( conf["viur.mainApp"] ): #Check for our custom user-api
-					userid = conf["viur.mainApp"].user.getCurrentUser()["key"]
+				stored = memcache.set( self.key, sessionData, time=conf[ "viur.session.lifeTime" ], namespace=self.kindName )
 			except:
-				pass
-			try:
-				dbSession = db.Entity( self.kindName, name=self.key )
-				dbSession["data"] = serialized
-				dbSession["sslkey"] = self.sslKey
-				dbSession["skey"] = self.sessionSecurityKey
-				dbSession["lastseen"] = time()
-				dbSession["user"] = str(userid) or "guest" #Store the userid inside the sessionobj, so we can kill specific sessions if needed
-				dbSession.set_unindexed_properties( ["data","sslkey" ] )
-				db.Put( dbSession )
-			except (OverQuotaError, CapabilityDisabledError):
-				pass
+				stored = False
+			if not stored:
+				# Memcache is unavailable; don't lose this change and don't serve the outdated copy
+				if not persist:
+					self.persistSessionData( sessionData )
+				try:
+					memcache.delete( self.key, namespace=self.kindName )
+				except:
+					pass
+			self.userid = userid
+			self.dataChanged = False
+			self.persistRequired = False
 			req.response.headers.add_header( "Set-Cookie", bytes( "%s=%s; Max-Age=99999; Path=/; HttpOnly" % ( self.plainCookieName, self.key ) ) )
 			if req.isSSLConnection:
 				req.response.headers.add_header( "Set-Cookie", bytes( "%s=%s; Max-Age=99999; Path=/; Secure; HttpOnly" % ( self.sslCookieName, self.sslKey ) ) )
 
 
+	def getCurrentUserId( self ):
+		"""
+			Returns the key of the user currently logged in (or None).
+		"""
+		try:
+			if "user" in dir( conf["viur.mainApp"] ): #Check for our custom user-api
+				return( conf["viur.mainApp"].user.getCurrentUser()["key"] )
+		except:
+			pass
+		return( None )
+
+	def persistSessionData( self, sessionData ):
+		"""
+			Writes *sessionData* through to the datastore.
+		"""
+		try:
+			dbSession = db.Entity( self.kindName, name=self.key )
+			for k in ["sslkey", "skey", "lastseen", "user", "version"]:
+				dbSession[ k ] = sessionData[ k ]
+			dbSession["data"] = Blob( sessionData["data"] )
+			dbSession.set_unindexed_properties( ["data","sslkey","version"] )
+			db.Put( dbSession )
+		except (OverQuotaError, CapabilityDisabledError):
+			return
+		self.persistedVersion = sessionData["version"]
+		self.persistedTime = sessionData["lastseen"]
+
 	def __contains__( self, key ):
 		"""
 			Returns True if the given *key* is set in the current session.
@@ -218,6 +520,7 @@ class GaeSession:
 		"""
 		del self.session[key]
 		self.changed = True
+		self.dataChanged = True
 
 	def __getitem__( self, key ):
 		"""
@@ -250,6 +553,7 @@ class GaeSession:
 		"""
 		self.session[ key ] = item
 		self.changed = True
+		self.dataChanged = True
 
 	def markChanged(self):
 		"""
@@ -259,6 +563,7 @@ class GaeSession:
 			not changed.
 		"""
 		self.changed = True
+		self.dataChanged = True
 
 	def reset(self):
 		"""
@@ -272,10 +577,13 @@ class GaeSession:
 		lang = self.session.get("language")
 		if self.key:
 			db.Delete(db.Key.from_path(self.kindName, self.key))
+			memcache.delete( self.key, namespace=self.kindName )
 		self.key = None
 		self.sslKey = None
 		self.sessionSecurityKey = None
 		self.changed = True
+		self.dataChanged = True
+		self.persistRequired = True
 		self.session = {}
 		if lang:
 			self.session["language"] = lang
@@ -292,6 +600,7 @@ class GaeSession:
 			from server.request import current
 			req = current.get()
 		self.key = ''.join(random.choice(string.ascii_lowercase+string.ascii_uppercase + string.digits) for x in range(42))
+		self.persistRequired = True
 		if req.isSSLConnection:
 			self.sslKey = ''.join(random.choice(string.ascii_lowercase+string.ascii_uppercase + string.digits) for x in range(42))
 		else:
@@ -313,8 +622,181 @@ class GaeSession:
 		"""
 		return( self.session.items() )
 
+class CookieSession( GaeSession ):
+	"""
+		Keeps small sessions of anonymous visitors inside a signed cookie instead of the datastore.
+
+		The session is stored client-side (signed using HMAC-SHA256 and, if conf["viur.session.cookieEncryption"]
+		is set, encrypted using AES) as long as its data can be serialized without pickle (see :func:`encodeSessionData`) and its cookie fits into
+		conf["viur.session.cookieMaxSize"] bytes. As soon as that's no longer the case, a user logs in or
+		its session key is requested (fe. by session-bound security keys), it's moved to the datastore and
+		handled like any other :class:`GaeSession`.
+
+		Set conf["viur.session.backend"] to this class to use it.
+	"""
+	signedCookieName = "viurSignedCookie"
+
+	def load( self, req ):
+		"""
+			Initializes the Session.
+
+			Sessions stored server-side take precedence; otherwise the session is
+			restored from the signed cookie (if its valid and not expired).
+		"""
+		self.clearSignedCookie = False
+		res = GaeSession.load( self, req )
+		if not self.signedCookieName in req.request.cookies:
+			return( res )
+		if self.plainCookieName in req.request.cookies:
+			# This session has been moved to the datastore
+			self.clearSignedCookie = True
+			return( res )
+		data = self.decodeCookie( req.request.cookies[ self.signedCookieName ] )
+		if not data or data["lastseen"] < time() - conf[ "viur.session.lifeTime" ]:
+			# Invalid signature or this session is too old
+			self.clearSignedCookie = True
+			return( False )
+		self.session = data["data"]
+		self.sslKey = data["sslkey"]
+		self.sessionSecurityKey = data["skey"]
+		if req.isSSLConnection and not (self.sslCookieName in req.request.cookies and req.request.cookies[ self.sslCookieName ] == self.sslKey and self.sslKey ):
+			if self.sslKey:
+				logging.warning("Possible session hijack attempt! Session dropped.")
+			self.reset()
+			return( False )
+		if data["lastseen"] < time()-5*60: #Refresh every 5 Minutes
+			self.changed = True
+		self.validatedKey = "signed-%s" % self.sessionSecurityKey
+		return( True )
+
+	def save( self, req ):
+		"""
+			Writes the session into the signed cookie or - if its too large,
+			not serializable without pickle or belongs to a user - into the memcache/datastore.
+
+			Does nothing, if the session hasn't been changed in the current request.
+		"""
+		if self.changed and not self.key and self.getCurrentUserId() is None:
+			if not self.sessionSecurityKey:
+				self.sslKey = utils.generateRandomString( 42 ) if req.isSSLConnection else ""
+				self.sessionSecurityKey = utils.generateRandomString( 13 )
+			cookie = self.encodeCookie( {
+				"data": self.session,
+				"sslkey": self.sslKey,
+				"skey": self.sessionSecurityKey,
+				"lastseen": time()
+			} )
+			if cookie and len( cookie ) <= conf[ "viur.session.cookieMaxSize" ]:
+				req.response.headers.add_header( "Set-Cookie", bytes( "%s=%s; Max-Age=99999; Path=/; HttpOnly" % ( self.signedCookieName, cookie ) ) )
+				if req.isSSLConnection:
+					req.response.headers.add_header( "Set-Cookie", bytes( "%s=%s; Max-Age=99999; Path=/; Secure; HttpOnly" % ( self.sslCookieName, self.sslKey ) ) )
+				self.changed = False
+				return
+			# This session has to be stored server-side from now on
+			self.clearSignedCookie = True
+		GaeSession.save( self, req )
+		if self.clearSignedCookie:
+			req.response.headers.add_header( "Set-Cookie", bytes( "%s=; Max-Age=0; Path=/; HttpOnly" % self.signedCookieName ) )
+			self.clearSignedCookie = False
+
+	def getSessionKey( self, req=None ):
+		"""
+			Moves this session to the datastore (if it isn't already) and returns its session-key.
+
+			The keys stored in the cookie are kept, so security keys issued
+			for this session remain valid.
+		"""
+		sslKey, sessionSecurityKey = self.sslKey, self.sessionSecurityKey
+		res = GaeSession.getSessionKey( self, req )
+		self.sslKey = sslKey or self.sslKey
+		self.sessionSecurityKey = sessionSecurityKey or self.sessionSecurityKey
+		return( res )
+
+	def getSessionSecurityKey( self ):
+		"""
+			Returns the security key for this session; unlike :class:`GaeSession`,
+			it's created right away without moving the session to the datastore.
+		"""
+		if not self.sessionSecurityKey and not self.key:
+			from server.request import current
+			self.sslKey = utils.generateRandomString( 42 ) if current.get().isSSLConnection else ""
+			self.sessionSecurityKey = utils.generateRandomString( 13 )
+			self.changed = True
+		return( GaeSession.getSessionSecurityKey( self ) )
+
+	def getCookieKeys( self ):
+		"""
+			Derives the keys used to sign (and encrypt) cookies from the application's session secret.
+
+			:returns: Tuple of signing key and encryption key
+		"""
+		secret = utils.getSecret( "session" )
+		return( hmac.new( secret, "sign", hashlib.sha256 ).digest(),
+				hmac.new( secret, "encrypt", hashlib.sha256 ).digest() )
+
+	def encodeCookie( self, data ):
+		"""
+			Serializes, signs and (optionally) encrypts *data*.
+
+			:returns: The cookie value or None if *data* cannot be stored client-side
+		"""
+		try:
+			payload = encodeSessionData( data, allowPickle=False )
+		except ValueError:
+			return( None )
+		signKey, encryptKey = self.getCookieKeys()
+		if conf[ "viur.session.cookieEncryption" ]:
+			if AES is None:
+				raise ImportError("Encrypted session cookies require pycrypto")
+			nonce = os.urandom( 8 )
+			cipher = AES.new( encryptKey, AES.MODE_CTR, counter=Counter.new( 64, prefix=nonce ) )
+			payload = "e" + nonce + cipher.encrypt( payload )
+		else:
+			payload = "p" + payload
+		signature = hmac.new( signKey, payload, hashlib.sha256 ).hexdigest()
+		return( "%s.%s" % ( base64.urlsafe_b64encode( payload ).rstrip("="), signature ) )
+
+	def decodeCookie( self, cookie ):
+		"""
+			Verifies and restores the data stored in *cookie* by :meth:`encodeCookie`.
+
+			:returns: The data stored or None if the cookie is invalid
+		"""
+		try:
+			payload, signature = str( cookie ).split(".")
+			payload = base64.urlsafe_b64decode( payload + "=" * ( -len( payload ) % 4 ) )
+		except (ValueError, TypeError, UnicodeEncodeError):
+			return( None )
+		signKey, encryptKey = self.getCookieKeys()
+		if not utils.safeStringComparison( hmac.new( signKey, payload, hashlib.sha256 ).hexdigest(), signature ):
+			return( None )
+		if payload.startswith("e"):
+			if AES is None:
+				return( None )
+			cipher = AES.new( encryptKey, AES.MODE_CTR, counter=Counter.new( 64, prefix=payload[ 1:9 ] ) )
+			payload = cipher.decrypt( payload[ 9: ] )
+		else:
+			payload = payload[ 1: ]
+		try:
+			return( decodeSessionData( payload, allowPickle=False ) )
+		except (ValueError, TypeError, EOFError, zlib.error):
+			return( None )
+
+
+def deleteSessions( keys ):
+	"""
+		Removes the given sessions from the datastore and memcache (using one batch-call each).
+
+		:param keys: Keys of the viur-session entities to delete
+		:type keys: list of server.db.Key
+	"""
+	if not keys:
+		return
+	db.Delete( keys )
+	memcache.delete_multi( [ x.name() for x in keys ], namespace=GaeSession.kindName )
+
 @callDeferred
-def killSessionByUser( user=None ):
+def killSessionByUser( user=None, cursor=None ):
 	"""
 		Invalidates all active sessions for the given *user*.
 
@@ -322,16 +804,26 @@ def killSessionByUser( user=None ):
 		If no user is given, it tries to invalidate **all** active sessions.
 
 		Use "guest" as to kill all sessions not associated with an user.
+		(Sessions held by :class:`CookieSession` inside a cookie cannot be invalidated.)
+
+		Sessions are looked up using the index on their user property and deleted
+		in batches of __clearSessionsMaxBatchSize__.
 
 		:param user: UserID, "guest" or None.
 		:type user: str | None
+		:param cursor: Internal; The cursor to continue from
 	"""
-	logging.error("Invalidating all sessions for %s" % user )
+	if cursor is None:
+		logging.error("Invalidating all sessions for %s" % user )
 	query = db.Query( GaeSession.kindName )
 	if user is not None:
 		query.filter( "user =", str(user) )
-	for key in query.iter(keysOnly=True):
-		db.Delete( key )
+	if cursor:
+		query.cursor( cursor )
+	keys = query.run( __clearSessionsMaxBatchSize__, keysOnly=True )
+	deleteSessions( keys )
+	if len( keys ) == __clearSessionsMaxBatchSize__:
+		killSessionByUser( user, query.getCursor().urlsafe() )
 
 @PeriodicTask(60*4)
 def startClearSessions():
@@ -341,14 +833,29 @@ def startClearSessions():
 	doClearSessions( time() - ( conf[ "viur.session.lifeTime" ] + 300 ), None )
 
 @callDeferred
-def doClearSessions( timeStamp, cursor ):
-	gotAtLeastOne = False
+def doClearSessions( timeStamp, cursor, batchSize=__clearSessionsMinBatchSize__, deletedCount=0 ):
+	"""
+		Deletes expired sessions in keys-only batches.
+
+		Each batch schedules the next one. While batches come back full (so there's a backlog),
+		the batch size is doubled up to __clearSessionsMaxBatchSize__.
+
+		:param timeStamp: Sessions last seen before this time are deleted
+		:type timeStamp: float
+		:param cursor: Internal; The cursor to continue from
+		:param batchSize: Internal; How many sessions to delete in this run
+		:param deletedCount: Internal; How many sessions the previous runs have deleted
+	"""
 	query = db.Query( GaeSession.kindName ).filter( "lastseen <", timeStamp )
-	for oldKey in query.run(100, keysOnly=True):
-		gotAtLeastOne = True
-		db.Delete( oldKey )
-	newCursor = query.getCursor()
-	if gotAtLeastOne and newCursor and newCursor.urlsafe()!=cursor:
-		doClearSessions( timeStamp, newCursor.urlsafe() )
+	if cursor:
+		query.cursor( cursor )
+	keys = query.run( batchSize, keysOnly=True )
+	deleteSessions( keys )
+	deletedCount += len( keys )
+	if len( keys ) == batchSize:
+		logging.info( "Clearing expired sessions: %s deleted so far" % deletedCount )
+		doClearSessions( timeStamp, query.getCursor().urlsafe(), min( batchSize*2, __clearSessionsMaxBatchSize__ ), deletedCount )
+	elif deletedCount:
+		logging.debug( "Cleared %s expired sessions" % deletedCount )
 
 current = SessionWrapper( GaeSession )
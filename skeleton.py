@@ -1,13 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from server import db, utils, conf, errors
+from server import db, utils, conf, errors, cache
 from server.bones import baseBone, boneFactory, keyBone, dateBone, selectBone, relationalBone, stringBone
 from server.tasks import CallableTask, CallableTaskBase, callDeferred
 from collections import OrderedDict
 from threading import local
 from time import time
 import inspect, os, sys, logging, copy
-from google.appengine.api import search
+from google.appengine.api import search, taskqueue
+from hashlib import sha256
 
 try:
 	import pytz
@@ -58,6 +59,65 @@ def iterAllSkelClasses():
 	for cls in MetaBaseSkel._allSkelClasses:
 		yield cls
 
+__maxTxnEntityGroups__ = 25  # Maximum number of entity groups touched by one xg transaction
+__maxSearchBatchSize__ = 200  # Maximum number of documents put/removed in one call to the search API
+__updateRelationsDelay__ = 5  # Changes to the same entity within this amount of seconds are propagated in one run
+__updateRelationsPageSize__ = 500  # Amount of viur-relations entries fetched (keys only) by each updateRelations call
+__updateRelationsShardSize__ = 25  # Amount of referencing entities updated by each updateRelationsShard call
+
+_referencedBonesCache = {}  # Mapping kindName -> set of boneNames copied by relationalBones
+
+
+class _UniqueValueClaimedError(ValueError):
+	"""
+		Raised by Skeleton._txnUpdate if the value of an unique bone has been claimed by another entity.
+		It's raised before anything has been written, so toDBMulti can skip that skeleton.
+	"""
+	pass
+
+def getReferencedBoneNames(kindName):
+	"""
+		Returns the names of all bones of *kindName* that are copied into other entities
+		by relationalBones (their refKeys). Only changes to these bones must be propagated
+		by :func:`updateRelations`.
+
+		:param kindName: The kind the relationalBones point to
+		:type kindName: str
+		:returns: Set of bone names
+		:rtype: set
+	"""
+	if kindName not in _referencedBonesCache:
+		res = set()
+		for cls in iterAllSkelClasses():
+			for key in dir(cls):
+				bone = getattr(cls, key)
+				if isinstance(bone, relationalBone) and bone.kind == kindName:
+					res.update(bone.refKeys or [])
+		_referencedBonesCache[kindName] = res
+	return _referencedBonesCache[kindName]
+
+def _writeSearchDocuments(searchDocuments):
+	"""
+		Writes the documents collected by Skeleton._finishToDB in batches.
+
+		:param searchDocuments: Mapping of indexName -> (list of documents to put, list of document ids to remove)
+		:type searchDocuments: dict
+	"""
+	for indexName, (docs, removedDocs) in searchDocuments.items():
+		index = search.Index(name=indexName)
+
+		for x in range(0, len(docs), __maxSearchBatchSize__):
+			try:
+				index.put(docs[x:x + __maxSearchBatchSize__])
+			except:
+				pass
+
+		for x in range(0, len(removedDocs), __maxSearchBatchSize__):
+			try:
+				index.remove(removedDocs[x:x + __maxSearchBatchSize__])
+			except:
+				pass
+
 
 class BaseSkeleton(object):
 	"""
@@ -291,7 +351,7 @@ class BaseSkeleton(object):
 		del self.valuesCache[key]
 		#del self.__dataDict__[ key ]
 
-	def setValues(self, values):
+	def setValues(self, values, boneNames=None):
 		"""
 			Load *values* into Skeleton, without validity checks.
 
@@ -306,8 +366,12 @@ class BaseSkeleton(object):
 
 			:param values: A dictionary with values.
 			:type values: dict
+			:param boneNames: If set, only these bones (and the key) are loaded.
+			:type boneNames: list of str
 		"""
 		for bkey,_bone in self.items():
+			if boneNames is not None and bkey != "key" and not bkey in boneNames:
+				continue
 			if isinstance( _bone, baseBone ):
 				if bkey=="key":
 					try:
@@ -420,11 +484,25 @@ class BaseSkeleton(object):
 			This function causes a refresh of all relational bones and their associated
 			information.
 		"""
+		# Fetch the entities referenced by all relational bones at once
+		prefetchKeys = set()
 		for key,bone in self.items():
-			if not isinstance( bone, baseBone ):
-				continue
-			if "refresh" in dir( bone ):
-				bone.refresh( self.valuesCache, key, self )
+			if isinstance( bone, relationalBone ):
+				prefetchKeys.update( bone.getRefreshKeys( self.valuesCache, key ) )
+		prefetched = dict.fromkeys( prefetchKeys )
+		if prefetchKeys:
+			for entity in db.Get( list( prefetchKeys ) ):
+				if entity is not None:
+					prefetched[ str( entity.key() ) ] = entity
+		super(BaseSkeleton, self).__setattr__( "_prefetchedEntities", prefetched )
+		try:
+			for key,bone in self.items():
+				if not isinstance( bone, baseBone ):
+					continue
+				if "refresh" in dir( bone ):
+					bone.refresh( self.valuesCache, key, self )
+		finally:
+			super(BaseSkeleton, self).__setattr__( "_prefetchedEntities", None )
 
 
 class MetaSkel(MetaBaseSkel):
@@ -528,19 +606,7 @@ class Skeleton(BaseSkeleton):
 			:rtype: bool
 
 		"""
-		if isinstance(key, basestring):
-			try:
-				key = db.Key(key)
-			except db.BadKeyError:
-				key = unicode(key)
-				if key.isdigit():
-					key = long(key)
-				elif not len(key):
-					raise ValueError("fromDB called with empty key!")
-				key = db.Key.from_path(self.kindName, key)
-		if not isinstance(key, db.Key):
-			raise ValueError(
-				"fromDB expects an db.Key instance, an string-encoded key or a long as argument, got \"%s\" instead" % key)
+		key = self._toDBKey(key)
 		if key.kind() != self.kindName:  # Wrong Kind
 			return (False)
 		try:
@@ -554,7 +620,69 @@ class Skeleton(BaseSkeleton):
 		self["key"] = key
 		return (True)
 
-	def toDB(self, clearUpdateTag=False):
+	@classmethod
+	def _toDBKey(cls, key):
+		"""
+			Converts the key-representations accepted by fromDB into a db.Key.
+		"""
+		if isinstance(key, basestring):
+			try:
+				key = db.Key(key)
+			except db.BadKeyError:
+				key = unicode(key)
+				if key.isdigit():
+					key = long(key)
+				elif not len(key):
+					raise ValueError("fromDB called with empty key!")
+				key = db.Key.from_path(cls.kindName, key)
+		if not isinstance(key, db.Key):
+			raise ValueError(
+				"fromDB expects an db.Key instance, an string-encoded key or a long as argument, got \"%s\" instead" % key)
+		return key
+
+	@classmethod
+	def fromDBMulti(cls, keys):
+		"""
+			Load many entities of this kind with one batched read.
+
+			If *cls* overrides fromDB, it's called for each skeleton (so its fixups are applied);
+			the entities are served from the request cache filled by the batched read in that case.
+
+			:param keys: List of keys accepted by :func:`~server.skeleton.Skeleton.fromDB`
+			:type keys: list
+
+			:returns: A list of skeletons in the order of *keys*, containing None for keys \
+			that could not be found or don't belong to this kind.
+			:rtype: list of Skeleton
+		"""
+		keys = [cls._toDBKey(x) for x in keys]
+		fetchKeys = [x for x in keys if x.kind() == cls.kindName]
+		entities = {}
+
+		if fetchKeys:
+			for dbRes in db.Get(fetchKeys):
+				if dbRes is not None:
+					entities[str(dbRes.key())] = dbRes
+
+		overridesFromDB = cls.fromDB.__func__ is not Skeleton.fromDB.__func__
+		res = []
+		for key in keys:
+			dbRes = entities.get(str(key))
+			if dbRes is None:
+				res.append(None)
+				continue
+			skel = cls()
+			if overridesFromDB:
+				if not skel.fromDB(str(dbRes.key())):
+					skel = None
+			else:
+				skel.setValues(dbRes)
+				skel["key"] = str(dbRes.key())
+			res.append(skel)
+
+		return (res)
+
+	def toDB(self, clearUpdateTag=False, forceWrite=False):
 		"""
 			Store current Skeleton entity to data store.
 
@@ -568,208 +696,288 @@ class Skeleton(BaseSkeleton):
 				This avoids from being fetched by the background task updating relations.
 			:type clearUpdateTag: bool
 
+			:param forceWrite: If True, all bones are re-serialized and the entity is written even if \
+			its values didn't change since it has been read from the data store.
+			:type forceWrite: bool
+
 			:returns: The data store key of the entity.
 			:rtype: str
 		"""
 
-		def txnUpdate(key, mergeFrom, clearUpdateTag):
-			blobList = set()
-			skel = type(mergeFrom)()
+		key = self._prepareToDB(clearUpdateTag)
 
-			# Load the current values from Datastore or create a new, empty db.Entity
-			if not key:
-				dbObj = db.Entity(skel.kindName)
-				oldBlobLockObj = None
+		# Run our SaveTxn
+		if db.IsInTransaction():
+			res = self._txnUpdate(key, clearUpdateTag, forceWrite)
+		else:
+			res = db.RunInTransactionOptions(db.TransactionOptions(xg=True),
+			                                 self._txnUpdate, key, clearUpdateTag, forceWrite)
 
-			else:
-				k = db.Key(key)
-				assert k.kind() == skel.kindName, "Cannot write to invalid kind!"
+		searchDocuments = {}
+		key = self._finishToDB(clearUpdateTag, searchDocuments, *res)
+		_writeSearchDocuments(searchDocuments)
+		return (key)
 
-				try:
-					dbObj = db.Get(k)
+	def _prepareToDB(self, clearUpdateTag):
+		"""
+			Validates the arguments of toDB and performs outstanding "magic" operations.
 
-				except db.EntityNotFoundError:
-					dbObj = db.Entity(k.kind(), id=k.id(), name=k.name(), parent=k.parent())
+			:returns: The key we'll write to (None if its an add)
+			:rtype: str | None
+		"""
+		key = self["key"] or None
+		if not isinstance(clearUpdateTag, bool):
+			raise ValueError(
+				"Got an unsupported type %s for clearUpdateTag. toDB doesn't accept a key argument any more!" % str(
+					type(clearUpdateTag)))
 
-				else:
-					skel.setValues(dbObj)
+		# Allow bones to perform outstanding "magic" operations before saving to db
+		for bkey, _bone in self.items():
+			_bone.performMagic(self.valuesCache, bkey, isAdd=(key == None))
 
-				try:
-					oldBlobLockObj = db.Get(db.Key.from_path("viur-blob-locks", str(k)))
+		return key
 
-				except:
-					oldBlobLockObj = None
+	def _txnUpdate(self, key, clearUpdateTag, forceWrite):
+		"""
+			Writes this skeleton into the data store; must be called inside a (xg) transaction.
 
-			# Merge values and assemble unique properties
-			oldUniqueValues = {}
-			for key, bone in skel.items():
-				# Remember old hashes for bones that must have an unique value
-				if bone.unique:
-					if "%s.uniqueIndexValue" % key in dbObj:
-						oldUniqueValues[key] = dbObj["%s.uniqueIndexValue" % key]
+			:returns: The key written, the written db.Entity, the skeleton used to assemble it and \
+			the set of bones that changed (None if all bones have been written, an empty set if nothing \
+			has been written at all)
+			:rtype: (str, db.Entity, Skeleton, set | None)
+		"""
+		blobList = set()
+		skel = type(self)()
+		isUpdate = False
 
-				# Merge the values from mergeFrom in
-				if key in mergeFrom:
-					bone.mergeFrom(skel.valuesCache, key, mergeFrom)
+		# The values of bones that must be unique only depend on this skeleton, so we can fetch their
+		# lock-objects within the same batch as the entity and its blob-lock object
+		newUniqueValues = {}
+		uniqueLockKeys = {}
+		for boneName, bone in skel.items():
+			if bone.unique:
+				newUniqueValues[boneName] = bone.getUniquePropertyIndexValue(self.valuesCache, boneName)
+				if newUniqueValues[boneName] is not None:
+					uniqueLockKeys[boneName] = db.Key.from_path(
+						"%s_%s_uniquePropertyIndex" % (skel.kindName, boneName),
+						newUniqueValues[boneName])
+
+		readKeys = list(uniqueLockKeys.values())
+		if key:
+			k = db.Key(key)
+			assert k.kind() == skel.kindName, "Cannot write to invalid kind!"
+			readKeys = [k, db.Key.from_path("viur-blob-locks", str(k))] + readKeys
+
+		# Fetch everything we need in one round trip
+		readResults = {}
+		if readKeys:
+			readResults = dict(zip([str(x) for x in readKeys], db.Get(readKeys)))
+
+		# Use the current values from Datastore or create a new, empty db.Entity
+		if not key:
+			dbObj = db.Entity(skel.kindName)
+			oldBlobLockObj = None
 
-				# Serialize bone into entity
-				dbObj = bone.serialize(skel.valuesCache, key, dbObj)
+		else:
+			dbObj = readResults[str(k)]
 
-				# Obtain referenced blobs
-				blobList.update(bone.getReferencedBlobs(self.valuesCache, key))
+			if dbObj is None:
+				dbObj = db.Entity(k.kind(), id=k.id(), name=k.name(), parent=k.parent())
 
-			if clearUpdateTag:
-				# Mark this entity as Up-to-date.
-				dbObj["viur_delayed_update_tag"] = 0
 			else:
-				# Mark this entity as dirty, so the background-task will catch it up and update its references.
-				dbObj["viur_delayed_update_tag"] = time()
+				skel.setValues(dbObj)
+				isUpdate = not forceWrite
 
-			dbObj = skel.preProcessSerializedData(dbObj)
+			oldBlobLockObj = readResults[str(readKeys[1])]
 
-			try:
-				ourKey = str(dbObj.key())
-			except:  # Its not an update but an insert, no key yet
-				ourKey = None
+		# Merge values and assemble unique properties
+		oldUniqueValues = {}
+		changedBones = set()
+		magicBones = []  # Changed updateMagic-bones of an update, only serialized if something else changed, too
+		for key, bone in skel.items():
+			# Remember old hashes for bones that must have an unique value
+			if bone.unique:
+				if "%s.uniqueIndexValue" % key in dbObj:
+					oldUniqueValues[key] = dbObj["%s.uniqueIndexValue" % key]
+
+			# Merge our values in
+			if key in self:
+				oldValue = skel.valuesCache.get(key)
+				bone.mergeFrom(skel.valuesCache, key, self)
+				if skel.valuesCache.get(key) != oldValue:
+					changedBones.add(key)
+
+			# Rewrite values still stored in an outdated format
+			if isUpdate and bone.isSerializationOutdated(key, dbObj):
+				changedBones.add(key)
+
+			# Serialize bone into entity; untouched bones are already stored in dbObj
+			if isUpdate and key in changedBones and getattr(bone, "updateMagic", False):
+				magicBones.append(key)
+			elif not isUpdate or key in changedBones:
+				dbObj = bone.serialize(skel.valuesCache, key, dbObj)
 
-			# Lock hashes from bones that must have unique values
-			newUniqueValues = {}
-			tags = []
+			# Obtain referenced blobs
+			blobList.update(bone.getReferencedBlobs(self.valuesCache, key))
 
-			for key, bone in skel.items():
-				if bone.unique:
-					# Check if the property is really unique
-					newUniqueValues[key] = bone.getUniquePropertyIndexValue(self.valuesCache, key)
+		if isUpdate and not any([not getattr(getattr(skel, x), "updateMagic", False) for x in changedBones]):
+			# Nothing except the updateMagic-bones changed; there is nothing to write except a pending update tag
+			if clearUpdateTag and dbObj.get("viur_delayed_update_tag"):
+				dbObj["viur_delayed_update_tag"] = 0
+				db.Put(dbObj)
+			return str(dbObj.key()), dbObj, skel, set()
 
-					if newUniqueValues[key] is not None:
-						try:
-							lockObj = db.Get(db.Key.from_path(
-								"%s_%s_uniquePropertyIndex" % (skel.kindName, key),
-								newUniqueValues[key]))
+		for key in magicBones:
+			dbObj = getattr(skel, key).serialize(skel.valuesCache, key, dbObj)
 
-							if lockObj["references"] != ourKey:
-								# This value has been claimed, and that not by us
+		if clearUpdateTag:
+			# Mark this entity as Up-to-date.
+			dbObj["viur_delayed_update_tag"] = 0
+		else:
+			# Mark this entity as dirty, so the background-task will catch it up and update its references.
+			dbObj["viur_delayed_update_tag"] = time()
 
-								raise ValueError(
-									"The unique value '%s' of bone '%s' has been recently claimed!" %
-										(self.valuesCache[key], key))
+		dbObj = skel.preProcessSerializedData(dbObj)
 
-						except db.EntityNotFoundError:  # No lockObj found for that value, we can use that
-							pass
-						dbObj["%s.uniqueIndexValue" % key] = newUniqueValues[key]
+		try:
+			ourKey = str(dbObj.key())
+		except:  # Its not an update but an insert, no key yet
+			ourKey = None
 
-					else:
-						if "%s.uniqueIndexValue" % key in dbObj:
-							del dbObj["%s.uniqueIndexValue" % key]
+		# Check the locks from bones that must have unique values
+		tags = []
 
-				if not skel.searchIndex:
-					# We generate the search index using the full skel, not this (maybe incomplete one)
-					if bone.searchable:
-						tags += [tag for tag in bone.getSearchTags(self.valuesCache, key)
-						            if tag not in tags and len(tag) < 400]
+		for key, bone in skel.items():
+			if bone.unique:
+				if newUniqueValues[key] is not None:
+					lockObj = readResults[str(uniqueLockKeys[key])]
 
-			if not skel.searchIndex:
-				dbObj["viur_tags"] = tags
+					if lockObj is not None and lockObj["references"] != ourKey:
+						# This value has been claimed, and that not by us
+						raise _UniqueValueClaimedError(
+							"The unique value '%s' of bone '%s' has been recently claimed!" %
+								(self.valuesCache[key], key))
 
-			# Write the core entry back
-			db.Put(dbObj)
+					dbObj["%s.uniqueIndexValue" % key] = newUniqueValues[key]
 
-			# Now write the blob-lock object
-			blobList = skel.preProcessBlobLocks(blobList)
+				else:
+					if "%s.uniqueIndexValue" % key in dbObj:
+						del dbObj["%s.uniqueIndexValue" % key]
 
-			if blobList is None:
-				raise ValueError(
-					"Did you forget to return the bloblist somewhere inside getReferencedBlobs()?")
+			if not skel.searchIndex:
+				# We generate the search index using the full skel, not this (maybe incomplete one)
+				if bone.searchable:
+					tags += [tag for tag in bone.getSearchTags(self.valuesCache, key)
+					            if tag not in tags and len(tag) < 400]
 
-			if None in blobList:
-				raise ValueError("None is not a valid blobKey.")
+		if not skel.searchIndex and (not isUpdate or "viur_tags" not in dbObj
+		                             or any([getattr(skel, x).searchable for x in changedBones])):
+			dbObj["viur_tags"] = tags
 
-			if oldBlobLockObj is not None:
-				oldBlobs = set(oldBlobLockObj["active_blob_references"]
-				                if oldBlobLockObj["active_blob_references"] is not None else [])
+		# New entities must be written first, as blob- and unique-locks refer to their key
+		if ourKey is None:
+			db.Put(dbObj)
+			writeList = []
+		else:
+			writeList = [dbObj]
 
-				removedBlobs = oldBlobs - blobList
-				oldBlobLockObj["active_blob_references"] = list(blobList)
+		# Now the blob-lock object
+		blobList = skel.preProcessBlobLocks(blobList)
 
-				if oldBlobLockObj["old_blob_references"] is None:
-					oldBlobLockObj["old_blob_references"] = [x for x in removedBlobs]
-				else:
-					tmp = set(oldBlobLockObj["old_blob_references"] + [x for x in removedBlobs])
-					oldBlobLockObj["old_blob_references"] = [x for x in (tmp - blobList)]
+		if blobList is None:
+			raise ValueError(
+				"Did you forget to return the bloblist somewhere inside getReferencedBlobs()?")
 
-				oldBlobLockObj["has_old_blob_references"] = \
-					oldBlobLockObj["old_blob_references"] is not None \
-						and len(oldBlobLockObj["old_blob_references"]) > 0
+		if None in blobList:
+			raise ValueError("None is not a valid blobKey.")
 
-				oldBlobLockObj["is_stale"] = False
-				db.Put(oldBlobLockObj)
+		if oldBlobLockObj is not None:
+			oldBlobs = set(oldBlobLockObj["active_blob_references"]
+			                if oldBlobLockObj["active_blob_references"] is not None else [])
 
-			else:  # We need to create a new blob-lock-object
-				blobLockObj = db.Entity("viur-blob-locks", name=str(dbObj.key()))
-				blobLockObj["active_blob_references"] = list(blobList)
-				blobLockObj["old_blob_references"] = []
-				blobLockObj["has_old_blob_references"] = False
-				blobLockObj["is_stale"] = False
-				db.Put(blobLockObj)
+			removedBlobs = oldBlobs - blobList
+			oldBlobLockObj["active_blob_references"] = list(blobList)
 
-			for key, bone in skel.items():
-				if bone.unique:
-					# Update/create/delete missing lock-objects
-					if key in oldUniqueValues and oldUniqueValues[key] != newUniqueValues[key]:
-
-						# We had an old lock and its value changed
-						try:
-							# Try to delete the old lock
-							oldLockObj = db.Get(db.Key.from_path(
-								"%s_%s_uniquePropertyIndex" % (skel.kindName, key),
-								oldUniqueValues[key]))
-							if oldLockObj["references"] != ourKey:
-								# We've been supposed to have that lock - but we don't.
-								# Don't remove that lock as it now belongs to a different entry
-								logging.critical(
-									"Detected Database corruption! A Value-Lock had been reassigned!")
-							else:
-								# It's our lock which we don't need anymore
-								db.Delete(db.Key.from_path(
-									"%s_%s_uniquePropertyIndex" % (
-									skel.kindName, key),
-									oldUniqueValues[key]))
-						except db.EntityNotFoundError as e:
-							logging.critical(
-								"Detected Database corruption! Could not delete stale lock-object!")
-
-					if newUniqueValues[key] is not None:
-						# Lock the new value
-						newLockObj = db.Entity(
-							"%s_%s_uniquePropertyIndex" % (skel.kindName, key),
-							name=newUniqueValues[key])
-						newLockObj["references"] = str(dbObj.key())
-						db.Put(newLockObj)
-
-			return str(dbObj.key()), dbObj, skel
-
-		# END of txnUpdate subfunction
+			if oldBlobLockObj["old_blob_references"] is None:
+				oldBlobLockObj["old_blob_references"] = [x for x in removedBlobs]
+			else:
+				tmp = set(oldBlobLockObj["old_blob_references"] + [x for x in removedBlobs])
+				oldBlobLockObj["old_blob_references"] = [x for x in (tmp - blobList)]
+
+			oldBlobLockObj["has_old_blob_references"] = \
+				oldBlobLockObj["old_blob_references"] is not None \
+					and len(oldBlobLockObj["old_blob_references"]) > 0
+
+			oldBlobLockObj["is_stale"] = False
+			writeList.append(oldBlobLockObj)
+
+		else:  # We need to create a new blob-lock-object
+			blobLockObj = db.Entity("viur-blob-locks", name=str(dbObj.key()))
+			blobLockObj["active_blob_references"] = list(blobList)
+			blobLockObj["old_blob_references"] = []
+			blobLockObj["has_old_blob_references"] = False
+			blobLockObj["is_stale"] = False
+			writeList.append(blobLockObj)
+
+		# Update/create/delete missing lock-objects
+		staleLockKeys = []
+		for key, bone in skel.items():
+			if bone.unique:
+				if key in oldUniqueValues and oldUniqueValues[key] != newUniqueValues[key]:
+					# We had an old lock and its value changed
+					staleLockKeys.append(db.Key.from_path(
+						"%s_%s_uniquePropertyIndex" % (skel.kindName, key),
+						oldUniqueValues[key]))
+
+				if newUniqueValues[key] is not None and readResults[str(uniqueLockKeys[key])] is None:
+					# Lock the new value
+					newLockObj = db.Entity(
+						"%s_%s_uniquePropertyIndex" % (skel.kindName, key),
+						name=newUniqueValues[key])
+					newLockObj["references"] = str(dbObj.key())
+					writeList.append(newLockObj)
+
+		# Write everything back in one batch
+		db.Put(writeList)
+
+		if staleLockKeys:
+			# Try to delete the old locks
+			deleteList = []
+			for lockKey, oldLockObj in zip(staleLockKeys, db.Get(staleLockKeys)):
+				if oldLockObj is None:
+					logging.critical(
+						"Detected Database corruption! Could not delete stale lock-object!")
+				elif oldLockObj["references"] != ourKey:
+					# We've been supposed to have that lock - but we don't.
+					# Don't remove that lock as it now belongs to a different entry
+					logging.critical(
+						"Detected Database corruption! A Value-Lock had been reassigned!")
+				else:
+					# It's our lock which we don't need anymore
+					deleteList.append(lockKey)
 
-		key = self["key"] or None
-		if not isinstance(clearUpdateTag, bool):
-			raise ValueError(
-				"Got an unsupported type %s for clearUpdateTag. toDB doesn't accept a key argument any more!" % str(
-					type(clearUpdateTag)))
+			if deleteList:
+				db.Delete(deleteList)
 
-		# Allow bones to perform outstanding "magic" operations before saving to db
-		for bkey, _bone in self.items():
-			_bone.performMagic(self.valuesCache, bkey, isAdd=(key == None))
+		return str(dbObj.key()), dbObj, skel, (changedBones if isUpdate else None)
 
-		# Run our SaveTxn
-		if db.IsInTransaction():
-			key, dbObj, skel = txnUpdate(key, self, clearUpdateTag)
-		else:
-			key, dbObj, skel = db.RunInTransactionOptions(db.TransactionOptions(xg=True),
-			                                              txnUpdate, key, self, clearUpdateTag)
+	def _finishToDB(self, clearUpdateTag, searchDocuments, key, dbObj, skel, changedBones):
+		"""
+			Performs the post-save operations after _txnUpdate has been committed.
 
+			Changes to the search index aren't written directly, they're collected in *searchDocuments*
+			(indexName -> (list of documents to put, list of document ids to remove)) instead.
+		"""
 		# Perform post-save operations (postProcessSerializedData Hook, Searchindex, ..)
 		self["key"] = str(key)
-		if self.searchIndex:  # Add a Document to the index if an index specified
+
+		# changedBones is None if all bones have been written, and an empty set if nothing has been written at all
+		if changedBones is not None and not changedBones:
+			skel.postSavedHandler(key, dbObj)
+			return (key)
+
+		if self.searchIndex and (changedBones is None or any([getattr(skel, x).searchable for x in changedBones])):
+			# Add a Document to the index if an index specified
 			fields = []
 
 			for boneName, bone in skel.items():
@@ -777,29 +985,104 @@ class Skeleton(BaseSkeleton):
 					fields.extend(bone.getSearchDocumentFields(self.valuesCache, boneName))
 
 			fields = skel.getSearchDocumentFields(fields)
+			docs, removedDocs = searchDocuments.setdefault(skel.searchIndex, ([], []))
 			if fields:
 				try:
-					doc = search.Document(doc_id="s_" + str(key), fields=fields)
-					search.Index(name=skel.searchIndex).put(doc)
+					docs.append(search.Document(doc_id="s_" + str(key), fields=fields))
 				except:
 					pass
 
 			else:  # Remove the old document (if any)
-				try:
-					search.Index(name=self.searchIndex).remove("s_" + str(key))
-				except:
-					pass
+				removedDocs.append("s_" + str(key))
 
 		for boneName, bone in skel.items():
 			bone.postSavedHandler(self.valuesCache, boneName, skel, key, dbObj)
 
+		# Responses depending on this entity may be stale now (cached query results have been invalidated on commit)
+		cache.flushDependentEntries(skel.kindName, key)
+
 		skel.postSavedHandler(key, dbObj)
 
-		if not clearUpdateTag:
-			updateRelations(key, time() + 1)
+		if not clearUpdateTag and (changedBones is None or changedBones & getReferencedBoneNames(skel.kindName)):
+			scheduleUpdateRelations(key)
 
 		return (key)
 
+	@classmethod
+	def toDBMulti(cls, skels, clearUpdateTag=False, forceWrite=False):
+		"""
+			Store many skeletons at once.
+
+			Skeletons are written together within xg transactions as far as the entity group limit of
+			a transaction allows; changes to the search index are written in batches afterwards.
+			The post-save operations are performed for each skeleton like in
+			:func:`~server.skeleton.Skeleton.toDB`. Skeletons whose class overrides toDB are
+			written by calling their toDB instead.
+
+			If the value of an unique bone of a skeleton has already been claimed, only this skeleton
+			is skipped (and None is returned for it); all others are written.
+
+			:param skels: The skeletons to store
+			:type skels: list of Skeleton
+
+			:param clearUpdateTag: See :func:`~server.skeleton.Skeleton.toDB`
+			:type clearUpdateTag: bool
+
+			:param forceWrite: See :func:`~server.skeleton.Skeleton.toDB`
+			:type forceWrite: bool
+
+			:returns: The data store keys of the entities, in the order of *skels* (None for skipped skeletons)
+			:rtype: list of str
+		"""
+		def txnUpdateMulti(chunk):
+			res = []
+			for skel, key in chunk:
+				try:
+					res.append(skel._txnUpdate(key, clearUpdateTag, forceWrite))
+				except _UniqueValueClaimedError as e:
+					logging.warning("Skipping %s: %s" % (key or "new entity", e))
+					res.append(None)
+			return res
+
+		res = [None] * len(skels)
+		batchSkels = []
+		for idx, skel in enumerate(skels):
+			if type(skel).toDB.__func__ is not Skeleton.toDB.__func__:
+				res[idx] = skel.toDB(clearUpdateTag, forceWrite)
+			else:
+				batchSkels.append((idx, skel))
+
+		# Each skeleton touches its entity, its blob-lock and (up to) two locks for each unique bone
+		chunks = [[]]
+		chunkGroups = 0
+		chunkKeys = set()
+		for idx, skel in batchSkels:
+			key = skel._prepareToDB(clearUpdateTag)
+			groups = 2 + 2 * len([x for x in skel.keys() if getattr(skel, x).unique])
+			if chunks[-1] and (chunkGroups + groups > __maxTxnEntityGroups__ or (key and key in chunkKeys)):
+				chunks.append([])
+				chunkGroups = 0
+				chunkKeys = set()
+			chunks[-1].append((skel, key))
+			chunkGroups += groups
+			chunkKeys.add(key)
+
+		results = []
+		for chunk in chunks:
+			if not chunk:
+				continue
+			if db.IsInTransaction():
+				results.extend(txnUpdateMulti(chunk))
+			else:
+				results.extend(db.RunInTransactionOptions(db.TransactionOptions(xg=True), txnUpdateMulti, chunk))
+
+		searchDocuments = {}
+		for (idx, skel), txnRes in zip(batchSkels, results):
+			if txnRes is not None:
+				res[idx] = skel._finishToDB(clearUpdateTag, searchDocuments, *txnRes)
+		_writeSearchDocuments(searchDocuments)
+		return (res)
+
 	def preProcessBlobLocks(self, locks):
 		"""
 			Can be overridden to modify the list of blobs referenced by this skeleton
@@ -882,6 +1165,7 @@ class Skeleton(BaseSkeleton):
 		db.RunInTransactionOptions(db.TransactionOptions(xg=True), txnDelete, key, skel)
 		for boneName, _bone in skel.items():
 			_bone.postDeletedHandler(skel, boneName, key)
+		cache.flushDependentEntries(skel.kindName, key)
 		skel.postDeletedHandler(key)
 		if self.searchIndex:
 			try:
@@ -1027,31 +1311,68 @@ class SkelList( list ):
 
 ### Tasks ###
 
+def scheduleUpdateRelations(destID):
+	"""
+		Schedules :func:`updateRelations` for the entity *destID*.
+
+		All changes to the same entity within a window of __updateRelationsDelay__ seconds
+		share one (named) task, which runs after that window has been closed.
+	"""
+	now = time()
+	windowEnd = (int(now / __updateRelationsDelay__) + 1) * __updateRelationsDelay__
+	taskName = "viur-updateRelations-%s-%s" % (sha256(str(destID)).hexdigest(), windowEnd)
+
+	try:
+		updateRelations(destID, windowEnd + 1, _name=taskName, _countdown=int(windowEnd - now) + 1)
+	except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+		pass  # There is already a run scheduled for this window
+
 @callDeferred
 def updateRelations(destID, minChangeTime, cursor=None):
+	"""
+		Pages through the relations referencing *destID* and fans them out to
+		:func:`updateRelationsShard` tasks.
+	"""
 	logging.debug("Starting updateRelations for %s ; minChangeTime %s", destID, minChangeTime)
 	updateListQuery = db.Query("viur-relations").filter("dest.key =", destID) \
 		.filter("viur_delayed_update_tag <", minChangeTime).filter("viur_relational_updateLevel =", 0)
 	if cursor:
 		updateListQuery.cursor(cursor)
-	updateList = updateListQuery.run(limit=5)
+	updateList = updateListQuery.run(limit=__updateRelationsPageSize__, keysOnly=True)
+
+	srcKeys = list(OrderedDict.fromkeys([str(x.parent()) for x in updateList]))
+	for x in range(0, len(srcKeys), __updateRelationsShardSize__):
+		updateRelationsShard(srcKeys[x:x + __updateRelationsShardSize__])
+
+	if len(updateList) == __updateRelationsPageSize__:
+		updateRelations(destID, minChangeTime, updateListQuery.getCursor().urlsafe())
+
+@callDeferred
+def updateRelationsShard(srcKeys):
+	"""
+		Refreshes the relational data of the given entities (which reference an entity that has been changed).
+	"""
+	keysByKind = OrderedDict()
+	for key in srcKeys:
+		keysByKind.setdefault(db.Key(key).kind(), []).append(key)
 
-	for srcRel in updateList:
+	for kindName, keys in keysByKind.items():
 		try:
-			skel = skeletonByKind(srcRel["viur_src_kind"])()
+			skelCls = skeletonByKind(kindName)
 		except AssertionError:
-			logging.info("Deleting %s which refers to unknown kind %s" % (str(srcRel.key()), srcRel["viur_src_kind"]))
+			logging.info("Ignoring %d references from unknown kind %s" % (len(keys), kindName))
 			continue
 
-		if not skel.fromDB( str(srcRel.key().parent()) ):
-			logging.warning("Cannot update stale reference to %s (referenced from %s)" % (str(srcRel.key().parent()), str(srcRel.key())))
-			continue
-		for key,_bone in skel.items():
-			_bone.refresh(skel.valuesCache, key, skel)
-		skel.toDB( clearUpdateTag=True )
+		skels = []
+		for key, skel in zip(keys, skelCls.fromDBMulti(keys)):
+			if skel is None:
+				logging.warning("Cannot update stale reference to %s" % key)
+				continue
+			# Refresh the bones only (as updateRelations always did); overridden refresh-methods aren't called
+			BaseSkeleton.refresh(skel)
+			skels.append(skel)
 
-	if len(updateList)==5:
-		updateRelations( destID, minChangeTime, updateListQuery.getCursor().urlsafe() )
+		skelCls.toDBMulti(skels, clearUpdateTag=True)
 
 
 @CallableTask
@@ -1109,21 +1430,19 @@ def processChunk(module, compact, cursor, allCount=0, notify=None):
 		logging.error("TaskUpdateSearchIndex: Invalid module")
 		return
 	query = Skel().all().cursor(cursor)
-	count = 0
-	for key in query.run(25, keysOnly=True):
-		count += 1
-		try:
-			skel = Skel()
-			skel.fromDB(str(key))
-			if compact=="YES":
-				raise NotImplementedError() #FIXME: This deletes the __currentKey__ property..
-				skel.delete()
+	keys = list(query.run(25, keysOnly=True))
+	count = len(keys)
+	if compact=="YES":
+		raise NotImplementedError() #FIXME: This deletes the __currentKey__ property..
+	try:
+		skels = [skel for skel in Skel.fromDBMulti(keys) if skel is not None]
+		for skel in skels:
 			skel.refresh()
-			skel.toDB(clearUpdateTag=True)
-		except Exception as e:
-			logging.error("Updating %s failed" % str(key) )
-			logging.exception( e )
-			raise
+		Skel.toDBMulti(skels, clearUpdateTag=True, forceWrite=True)
+	except Exception as e:
+		logging.error("Updating %s failed" % ", ".join([str(x) for x in keys]) )
+		logging.exception( e )
+		raise
 	newCursor = query.getCursor()
 	logging.info("END processChunk %s, %d records refreshed" % (module, count))
 	if count and newCursor and newCursor.urlsafe() != cursor:
@@ -274,8 +274,13 @@ def callDeferred( func ):
 			req = request.current.get()
 		except: #This will fail for warmup requests
 			req = None
-		if req is not None and "HTTP_X_APPENGINE_TASKRETRYCOUNT".lower() in [x.lower() for x in os.environ.keys()] and not "DEFERED_TASK_CALLED" in dir( req ): #This is the deferred call
+		# Transactional and named calls are always queued; running them directly would run them inside the caller's
+		# transaction or defeat the deduplication of named tasks
+		if req is not None and "HTTP_X_APPENGINE_TASKRETRYCOUNT".lower() in [x.lower() for x in os.environ.keys()] and not "DEFERED_TASK_CALLED" in dir( req ) \
+				and not kwargs.get( "_transactional" ) and not kwargs.get( "_name" ): #This is the deferred call
 			req.DEFERED_TASK_CALLED = True #Defer recursive calls to an deferred function again.
+			for x in ("countdown", "eta", "name", "target", "retry_options", "transactional", "queue"):
+				kwargs.pop("_%s" % x, None) #Task options don't apply to this direct call
 			if self is __undefinedFlag_:
 				return func(*args, **kwargs)
 			else:
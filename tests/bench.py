@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+	Helpers for the benchmarks in this directory (bench_*.py).
+
+	The benchmarks run against the App Engine SDK's local service stubs. They measure the number
+	of API calls (RPCs) an operation needs and its wall-clock time; the latter only allows comparing
+	the CPU overhead of the variants, as the stubs don't simulate any network latency.
+
+	Run them from the application's root directory, with the SDK set up like for the tests, e.g.::
+
+		python -m server.tests.bench_skeleton
+"""
+from collections import defaultdict
+from time import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import testbed
+
+_rpcCounts = defaultdict(int)
+_responseBytes = [0]
+_lastRepeat = [1]
+
+
+def _countRPC(service, call, request, response):
+	_rpcCounts["%s.%s" % (service, call)] += 1
+
+
+def _countResponseBytes(service, call, request, response):
+	_responseBytes[0] += response.ByteSize()
+
+
+def activateTestbed():
+	"""
+		Activates a testbed providing the stubs used by ViUR and starts counting the RPCs made
+		and the size of their responses.
+
+		:returns: The activated testbed
+	"""
+	tb = testbed.Testbed()
+	tb.activate()
+	tb.init_datastore_v3_stub()
+	tb.init_memcache_stub()
+	tb.init_taskqueue_stub()
+	tb.init_search_stub()
+	apiproxy_stub_map.apiproxy.GetPreCallHooks().Append("viur-bench", _countRPC)
+	apiproxy_stub_map.apiproxy.GetPostCallHooks().Append("viur-bench", _countResponseBytes)
+	return tb
+
+
+def measure(func, repeat=1):
+	"""
+		Calls *func* *repeat* times.
+
+		:returns: Milliseconds per call and the RPCs per call (service.method -> count)
+		:rtype: (float, dict)
+	"""
+	_rpcCounts.clear()
+	_responseBytes[0] = 0
+	start = time()
+	for x in range(0, repeat):
+		func()
+	duration = (time() - start) * 1000.0 / repeat
+	_lastRepeat[0] = repeat
+	return duration, dict((k, v / float(repeat)) for k, v in _rpcCounts.items())
+
+
+def responseBytes():
+	"""
+		Returns the size of all API responses received during the last call to :func:`measure`,
+		divided by its *repeat*.
+
+		:rtype: float
+	"""
+	return _responseBytes[0] / float(_lastRepeat[0])
+
+
+def formatRPCs(rpcs):
+	"""
+		Formats the RPC counts returned by :func:`measure` as one line.
+	"""
+	return ", ".join(["%s=%g" % (k, v) for k, v in sorted(rpcs.items())]) or "none"
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+	Measures the throughput of db.Get, db.Put and db.Delete for batches of 10, 100 and 1000 keys.
+"""
+from google.appengine.api import memcache
+from server.tests.bench import activateTestbed, measure, formatRPCs
+
+
+def main():
+	tb = activateTestbed()
+	from server import db, conf
+
+	conf["viur.db.requestCache"] = False  # Measure the memcache tier, not our in-process caches
+	for count in (10, 100, 1000):
+		entities = []
+		for x in range(0, count):
+			entity = db.Entity("bench")
+			entity["name"] = u"Entry %s" % x
+			entity["number"] = x
+			entities.append(entity)
+		state = {}
+
+		def putNew():
+			state["keys"] = db.Put(entities)
+
+		def getCold():
+			memcache.flush_all()
+			db.Get(state["keys"])
+
+		def getWarm():
+			db.Get(state["keys"])
+
+		def putUpdate():
+			db.Put(entities)
+
+		def delete():
+			db.Delete(state["keys"])
+
+		for name, func in (("Put (insert)", putNew), ("Get (datastore)", getCold), ("Get (memcache)", getWarm),
+		                   ("Put (update)", putUpdate), ("Delete", delete)):
+			if name == "Get (memcache)":
+				db.Get(state["keys"])  # Fill memcache
+			duration, rpcs = measure(func)
+			print("%4d keys, %-16s %8.1f ms %9.0f keys/s  %s" % (count, name, duration, count * 1000.0 / duration,
+			                                                      formatRPCs(rpcs)))
+	tb.deactivate()
+
+
+if __name__ == "__main__":
+	main()
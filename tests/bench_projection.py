@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""
+	Compares full, subset and projection queries listing two bones of a wide skeleton.
+"""
+from server.tests.bench import activateTestbed, measure, formatRPCs, responseBytes
+
+boneCount = 40
+
+
+def main():
+	tb = activateTestbed()
+	from server import conf
+	from server.skeleton import Skeleton
+	from server.bones import stringBone, numericBone
+
+	attrs = {"kindName": "viur-bench-wide", "name": stringBone(descr="Name", indexed=True),
+	         "number": numericBone(descr="Number", indexed=True)}
+	for x in range(0, boneCount):
+		attrs["field%s" % x] = stringBone(descr="Field %s" % x)
+	WideSkel = type(Skeleton)("WideSkel", (Skeleton,), attrs)
+
+	skels = []
+	for x in range(0, 100):
+		skel = WideSkel()
+		skel["name"] = u"Entry %s" % x
+		skel["number"] = x
+		for y in range(0, boneCount):
+			skel["field%s" % y] = u"Some text of about fifty characters in field %s" % y
+		skels.append(skel)
+	WideSkel.toDBMulti(skels, clearUpdateTag=True)
+
+	conf["viur.db.requestCache"] = False  # Entities are served from memcache, as they would be on the next request
+	for name, func in (("full", lambda: WideSkel().all().fetch(100)),
+	                   ("subset", lambda: WideSkel().all().subset("name", "number").fetch(100)),
+	                   ("projection", lambda: WideSkel().all().projection("name", "number").fetch(100))):
+		res = func()  # Warm up memcache
+		assert len(res) == 100 and res[0]["name"]
+		duration, rpcs = measure(func, repeat=10)
+		print("100 of %d bones, %-10s %7.1f ms %9d response bytes  %s" % (boneCount + 2, name, duration, responseBytes(),
+		                                                                   formatRPCs(rpcs)))
+	tb.deactivate()
+
+
+if __name__ == "__main__":
+	main()
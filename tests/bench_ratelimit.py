@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+	Counts the memcache RPCs RateLimit needs per check (isQuotaAvailable, followed by decrementQuota
+	if the call is allowed) for typical access patterns.
+"""
+from server.tests.bench import activateTestbed, measure, formatRPCs
+
+
+class FakeRequest(object):
+	def __init__(self, remoteAddr):
+		self.remote_addr = remoteAddr
+
+
+class FakeHandler(object):
+	def __init__(self, remoteAddr):
+		self.request = FakeRequest(remoteAddr)
+
+
+def main():
+	tb = activateTestbed()
+	from server import request
+	from server.ratelimit import RateLimit
+
+	def check(rateLimit):
+		if rateLimit.isQuotaAvailable():
+			rateLimit.decrementQuota()
+			return True
+		return False
+
+	def distinctActors():
+		# 100 visitors calling once each
+		rateLimit = RateLimit("bench-distinct", 10, 5, "ip")
+		for x in range(0, 100):
+			request.current.setRequest(FakeHandler("10.0.0.%s" % x))
+			check(rateLimit)
+
+	def withinQuota():
+		# One visitor calling 10 times, all allowed
+		rateLimit = RateLimit("bench-within", 100, 5, "ip")
+		request.current.setRequest(FakeHandler("10.0.1.1"))
+		for x in range(0, 10):
+			check(rateLimit)
+
+	def burst():
+		# One client hammering a login form 100 times; only about the first 10 attempts are allowed
+		rateLimit = RateLimit("bench-burst", 10, 5, "ip")
+		request.current.setRequest(FakeHandler("10.0.2.1"))
+		for x in range(0, 100):
+			check(rateLimit)
+
+	for name, func, checks in (("100 actors, 1 check each", distinctActors, 100),
+	                           ("1 actor, 10 allowed checks", withinQuota, 10),
+	                           ("1 actor, burst of 100 checks", burst, 100)):
+		duration, rpcs = measure(func)
+		print("%-30s %5.2f RPCs per check  %s" % (name, sum(rpcs.values()) / float(checks), formatRPCs(rpcs)))
+	tb.deactivate()
+
+
+if __name__ == "__main__":
+	main()
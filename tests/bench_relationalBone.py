@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+	Compares the storage format of relationalBone (stdlib json with tagged dates) with extjson,
+	used by previous versions, for typical relations.
+"""
+from datetime import datetime
+from server.tests.bench import activateTestbed, measure
+
+
+def main():
+	tb = activateTestbed()
+	import extjson
+	from server.bones.relationalBone import encodeRelation, decodeRelation
+
+	value = {
+		"dest": {
+			"key": u"ahFzfnZpdXItYmVuY2gtYXBwchALEgR1c2VyGICAgICAgIAKDA",
+			"name": u"Jane Doe",
+			"firstname": u"Jane",
+			"lastname": u"Doe",
+			"email": u"jane.doe@example.com",
+			"status": 10,
+			"tags": [u"customer", u"newsletter"],
+			"creationdate": datetime(2019, 3, 4, 10, 11, 12, 123456),
+			"changedate": datetime(2020, 6, 1, 12, 0, 0, 654321)
+		},
+		"rel": {
+			"role": u"owner",
+			"since": datetime(2019, 3, 4, 10, 11, 12)
+		}
+	}
+	count = 1000
+	jsonValues = [encodeRelation(value) for x in range(0, count)]
+	extjsonValues = [extjson.dumps(value) for x in range(0, count)]
+	print("%d relations, %d bytes each as json, %d bytes as extjson" % (count, len(jsonValues[0]), len(extjsonValues[0])))
+	for name, func in (("json encode", lambda: [encodeRelation(value) for x in range(0, count)]),
+	                   ("extjson encode", lambda: [extjson.dumps(value) for x in range(0, count)]),
+	                   ("json decode", lambda: [decodeRelation(x) for x in jsonValues]),
+	                   ("extjson decode", lambda: [decodeRelation(x) for x in extjsonValues])):
+		duration, rpcs = measure(func, repeat=10)
+		print("%-15s %8.1f ms" % (name, duration))
+	tb.deactivate()
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+"""
+	Compares Skeleton.fromDBMulti/toDBMulti with loading and saving the same skeletons one by one.
+"""
+from google.appengine.api import memcache
+from server.tests.bench import activateTestbed, measure, formatRPCs
+
+
+def main():
+	tb = activateTestbed()
+	from server import conf
+	from server.skeleton import Skeleton
+	from server.bones import stringBone, numericBone
+
+	class BenchSkel(Skeleton):
+		kindName = "viur-bench-skel"
+		name = stringBone(descr="Name", searchable=True)
+		number = numericBone(descr="Number")
+
+	def makeSkels(count):
+		res = []
+		for x in range(0, count):
+			skel = BenchSkel()
+			skel["name"] = u"Entry %s" % x
+			skel["number"] = x
+			res.append(skel)
+		return res
+
+	conf["viur.db.requestCache"] = False  # Each iteration should start cold
+	for count in (10, 100):
+		keys = BenchSkel.toDBMulti(makeSkels(count))
+
+		def loadSingle():
+			for key in keys:
+				BenchSkel().fromDB(key)
+
+		def loadMulti():
+			BenchSkel.fromDBMulti(keys)
+
+		def insertSingle():
+			for skel in makeSkels(count):
+				skel.toDB(clearUpdateTag=True)
+
+		def insertMulti():
+			BenchSkel.toDBMulti(makeSkels(count), clearUpdateTag=True)
+
+		def updateSingle():
+			for skel in BenchSkel.fromDBMulti(keys):
+				skel["number"] += 1
+				skel.toDB(clearUpdateTag=True)
+
+		def updateMulti():
+			skels = BenchSkel.fromDBMulti(keys)
+			for skel in skels:
+				skel["number"] += 1
+			BenchSkel.toDBMulti(skels, clearUpdateTag=True)
+
+		for name, func in (("fromDB", loadSingle), ("fromDBMulti", loadMulti),
+		                   ("toDB (insert)", insertSingle), ("toDBMulti (insert)", insertMulti),
+		                   ("toDB (update)", updateSingle), ("toDBMulti (update)", updateMulti)):
+			# Loads are served from memcache after the first run; flush it so each run hits the datastore
+			memcache.flush_all()
+			duration, rpcs = measure(func)
+			print("%4d skeletons, %-18s %8.1f ms  %s" % (count, name, duration, formatRPCs(rpcs)))
+	tb.deactivate()
+
+
+if __name__ == "__main__":
+	main()
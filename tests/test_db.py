@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+try:
+	from google.appengine.ext import testbed
+except ImportError:  # Not running inside the App Engine SDK
+	testbed = None
+
+
+@unittest.skipIf( testbed is None, "App Engine SDK not available" )
+class TestQueryCacheInvalidation( unittest.TestCase ):
+	def setUp( self ):
+		self.testbed = testbed.Testbed()
+		self.testbed.activate()
+		self.testbed.init_datastore_v3_stub()
+		self.testbed.init_memcache_stub()
+		from server import conf
+		self.oldQueryCache = conf[ "viur.db.queryCache" ]
+		conf[ "viur.db.queryCache" ] = True
+
+	def tearDown( self ):
+		from server import conf
+		conf[ "viur.db.queryCache" ] = self.oldQueryCache
+		self.testbed.deactivate()
+
+	def generation( self ):
+		from server.db import _getKindGenerations
+		return( _getKindGenerations( [ "testkind" ] )[ 0 ][ 1 ] )
+
+	def testPut( self ):
+		from server import db
+		before = self.generation()
+		db.Put( db.Entity( "testkind" ) )
+		self.assertGreater( self.generation(), before )
+
+	def testPutAsync( self ):
+		from server import db
+		before = self.generation()
+		rpc = db.PutAsync( db.Entity( "testkind" ) )
+		self.assertEqual( self.generation(), before )
+		key = rpc.get_result()
+		self.assertEqual( key.kind(), "testkind" )
+		afterWrite = self.generation()
+		self.assertGreater( afterWrite, before )
+		rpc.get_result()
+		self.assertEqual( self.generation(), afterWrite )
+		db.DeleteAsync( key ).get_result()
+		self.assertGreater( self.generation(), afterWrite )
+
+	def testTransaction( self ):
+		from server import db
+		before = self.generation()
+		def txn():
+			db.Put( db.Entity( "testkind" ) )
+			db.Put( db.Entity( "testkind" ) )
+			self.assertEqual( self.generation(), before )
+		db.RunInTransactionOptions( db.TransactionOptions( xg=True ), txn )
+		self.assertEqual( self.generation(), before + 1 )
+
+	def testFailedTransaction( self ):
+		from server import db
+		before = self.generation()
+		def txn():
+			db.Put( db.Entity( "testkind" ) )
+			raise ValueError()
+		self.assertRaises( ValueError, db.RunInTransaction, txn )
+		self.assertEqual( self.generation(), before )
+
+	def testQueryCacheKey( self ):
+		from server import db
+		def cacheKey( filters=(), orders=() ):
+			qry = db.Query( "testkind", srcSkelClass=object )
+			for k, v in filters:
+				qry.filter( k, v )
+			if orders:
+				qry.order( *orders )
+			return( qry._getQueryCacheKey( { "limit": 30 } ) )
+		self.assertEqual( cacheKey( [ ( "name", "a" ) ] ), cacheKey( [ ( "name", "a" ) ] ) )
+		self.assertNotEqual( cacheKey( [ ( "name", "a" ) ] ), cacheKey( [ ( "name", "b" ) ] ) )
+		self.assertNotEqual( cacheKey( orders=[ "name" ] ), cacheKey( orders=[ ( "name", db.DESCENDING ) ] ) )
+		self.assertNotEqual( cacheKey( [ ( "name IN", [ "a", "b" ] ) ] ), cacheKey( [ ( "name IN", [ "a", "c" ] ) ] ) )
+		before = cacheKey()
+		db.Put( db.Entity( "testkind" ) )
+		self.assertNotEqual( cacheKey(), before )
+
+
+@unittest.skipIf( testbed is None, "App Engine SDK not available" )
+class TestGet( unittest.TestCase ):
+	def setUp( self ):
+		self.testbed = testbed.Testbed()
+		self.testbed.activate()
+		self.testbed.init_datastore_v3_stub()
+		self.testbed.init_memcache_stub()
+		from server import request, conf
+		request.current.setRequest( object() )
+		self.oldCacheSize = conf[ "viur.db.requestCacheSize" ]
+
+	def tearDown( self ):
+		from server import request, conf
+		conf[ "viur.db.requestCacheSize" ] = self.oldCacheSize
+		request.current.setRequest( None )
+		self.testbed.deactivate()
+
+	def testMissingEntities( self ):
+		from server import db
+		keys = db.Put( [ db.Entity( "testkind" ), db.Entity( "testkind" ) ] )
+		missingKey = db.Key.from_path( "testkind", 4711 )
+		for x in range( 0, 2 ): #Uncached, then from the caches
+			res = db.Get( [ keys[ 0 ], missingKey, keys[ 1 ] ] )
+			self.assertEqual( [ x.key() if x is not None else None for x in res ], [ keys[ 0 ], None, keys[ 1 ] ] )
+
+	def testRequestCacheSize( self ):
+		from server import db, conf
+		conf[ "viur.db.requestCacheSize" ] = 2
+		keys = [ str( x ) for x in db.Put( [ db.Entity( "testkind" ) for x in range( 0, 3 ) ] ) ]
+		db.Get( keys[ 0 ] )
+		db.Get( keys[ 1 ] )
+		db.Get( keys[ 0 ] ) #keys[ 1 ] is now the least recently used entry
+		db.Get( keys[ 2 ] )
+		self.assertEqual( sorted( db._getRequestCache().keys() ), sorted( [ keys[ 0 ], keys[ 2 ] ] ) )
+
+
+if __name__ == "__main__":
+	unittest.main()
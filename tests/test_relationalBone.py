@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import unittest
+from datetime import datetime
+
+try:
+	from google.appengine.ext import testbed
+except ImportError:  # Not running inside the App Engine SDK
+	testbed = None
+
+try:
+	import pytz
+except ImportError:  # Localized dateBones require pytz
+	pytz = None
+
+
+@unittest.skipIf( testbed is None or pytz is None, "App Engine SDK or pytz not available" )
+class TestRelationPropertiesDiffer( unittest.TestCase ):
+	def setUp( self ):
+		self.testbed = testbed.Testbed()
+		self.testbed.activate()
+		self.testbed.init_datastore_v3_stub()
+		self.testbed.init_memcache_stub()
+
+	def tearDown( self ):
+		self.testbed.deactivate()
+
+	def serializeLocalized( self, value ):
+		"""
+			Serializes *value* like a localized dateBone in the refKeys of a relationalBone would
+			for a visitor from Germany.
+		"""
+		from server import db
+		from server.bones import dateBone
+		bone = dateBone( localize=True )
+		bone.guessTimeZone = lambda: "Europe/Berlin"
+		entity = db.Entity( "test" )
+		bone.serialize( { "changedate": value }, "changedate", entity )
+		return( entity[ "changedate" ] )
+
+	def testLocalizedDateBone( self ):
+		from server.bones.relationalBone import _relationPropertiesDiffer
+		newValue = self.serializeLocalized( datetime( 2020, 6, 1, 14, 0, 0 ) )
+		self.assertIsNotNone( newValue.tzinfo )
+		# The datastore returns the same point in time as naive datetime in UTC
+		dbObj = { "dest.changedate": datetime( 2020, 6, 1, 12, 0, 0 ) }
+		self.assertFalse( _relationPropertiesDiffer( dbObj, { "dest.changedate": newValue } ) )
+		dbObj = { "dest.changedate": datetime( 2020, 6, 1, 14, 0, 0 ) }
+		self.assertTrue( _relationPropertiesDiffer( dbObj, { "dest.changedate": newValue } ) )
+
+	def testOtherValues( self ):
+		from server.bones.relationalBone import _relationPropertiesDiffer
+		dbObj = { "dest.name": u"a", "dest.tags": [ u"x", u"y" ] }
+		self.assertFalse( _relationPropertiesDiffer( dbObj, { "dest.name": u"a", "dest.tags": [ u"x", u"y" ] } ) )
+		self.assertTrue( _relationPropertiesDiffer( dbObj, { "dest.name": u"b" } ) )
+		self.assertTrue( _relationPropertiesDiffer( dbObj, { "dest.missing": 1 } ) )
+
+
+@unittest.skipIf( testbed is None, "App Engine SDK not available" )
+class TestStorageFormat( unittest.TestCase ):
+	def isOutdated( self, val ):
+		from server.bones import relationalBone
+		return( relationalBone( kind="test" ).isSerializationOutdated( "rel", { "rel": val } ) )
+
+	def testCurrentFormat( self ):
+		from server.bones.relationalBone import encodeRelation, decodeRelation
+		value = { "dest": { "key": u"abc", "changedate": datetime( 2020, 6, 1, 12, 0, 0 ) }, "rel": None }
+		encoded = encodeRelation( value )
+		self.assertEqual( decodeRelation( encoded ), value )
+		self.assertFalse( self.isOutdated( [ encoded ] ) )
+
+	def testExtjsonFallback( self ):
+		import extjson
+		from server.bones.relationalBone import decodeRelation, __extjsonFormatPrefix__
+		value = { "dest": { "key": u"abc", "name": u"Test" }, "rel": None }
+		# Values that had to fall back to extjson are written in the current format, too
+		encoded = __extjsonFormatPrefix__ + extjson.dumps( value )
+		self.assertEqual( decodeRelation( encoded ), value )
+		self.assertFalse( self.isOutdated( [ encoded ] ) )
+		# Values written by previous versions are not
+		self.assertEqual( decodeRelation( extjson.dumps( value ) ), value )
+		self.assertTrue( self.isOutdated( [ extjson.dumps( value ) ] ) )
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import unittest
+from time import time
+
+try:
+	from google.appengine.ext import testbed
+except ImportError:  # Not running inside the App Engine SDK
+	testbed = None
+
+
+@unittest.skipIf( testbed is None, "App Engine SDK not available" )
+class TestSignedKeys( unittest.TestCase ):
+	def setUp( self ):
+		self.testbed = testbed.Testbed()
+		self.testbed.activate()
+		self.testbed.init_datastore_v3_stub()
+		self.testbed.init_memcache_stub()
+		from server import db, utils
+		utils._secrets.clear()
+		dbObj = db.Entity( "viur-secrets", name="securitykey" )
+		dbObj["secret"] = u"cd" * 32  # The datastore hands out strings as unicode
+		db.Put( dbObj )
+
+	def tearDown( self ):
+		self.testbed.deactivate()
+
+	def testSignedKeyWithUnicodeSecret( self ):
+		from server import securitykey
+		key = securitykey.createSignedKey( "abc", int( time() )+60, False )
+		self.assertTrue( securitykey.validateSignedKey( key ) )
+		self.assertFalse( securitykey.validateSignedKey( key ) )  # Replay
+
+	def testTamperedKey( self ):
+		from server import securitykey
+		nonce, until, scope, signature = securitykey.createSignedKey( "abc", int( time() )+60, False ).split(".")
+		self.assertFalse( securitykey.validateSignedKey( "%s.%s.%s.%s" % ( nonce, int( until )+60, scope, signature ) ) )
+
+	def testExpiredKey( self ):
+		from server import securitykey
+		self.assertFalse( securitykey.validateSignedKey( securitykey.createSignedKey( "abc", int( time() )-1, False ) ) )
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+try:
+	from google.appengine.ext import testbed
+except ImportError:  # Not running inside the App Engine SDK
+	testbed = None
+
+
+class FakeRequest( object ):
+	def __init__( self, cookies ):
+		self.cookies = cookies
+
+
+class FakeHandler( object ):
+	isSSLConnection = False
+
+	def __init__( self, cookies ):
+		self.request = FakeRequest( cookies )
+
+
+@unittest.skipIf( testbed is None, "App Engine SDK not available" )
+class TestHasSessionCookie( unittest.TestCase ):
+	def setUp( self ):
+		self.testbed = testbed.Testbed()
+		self.testbed.activate()
+		self.testbed.init_datastore_v3_stub()
+		self.testbed.init_memcache_stub()
+
+	def tearDown( self ):
+		from server import session
+		session.current.pendingRequest = None
+		self.testbed.deactivate()
+
+	def testWithoutCookie( self ):
+		from server import session
+		req = FakeHandler( {} )
+		session.current.load( req )
+		self.assertFalse( session.current.hasSessionCookie( req ) )
+		self.assertIs( session.current.pendingRequest, req ) # Not loaded
+
+	def testWithCookie( self ):
+		from server import session
+		req = FakeHandler( { session.GaeSession.plainCookieName: "abc" } )
+		session.current.load( req )
+		self.assertTrue( session.current.hasSessionCookie( req ) )
+		self.assertIs( session.current.pendingRequest, req ) # Not loaded
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import unittest
+
+try:
+	from google.appengine.ext import testbed
+except ImportError:  # Not running inside the App Engine SDK
+	testbed = None
+
+if testbed is not None:
+	from server.skeleton import Skeleton
+	from server.bones import stringBone
+
+	class BulkTestSkel( Skeleton ):
+		kindName = "viur-test-bulk"
+		name = stringBone( descr="Name", unique=True )
+
+	class FixupTestSkel( BulkTestSkel ):
+		kindName = "viur-test-fixup"
+
+		def fromDB( self, *args, **kwargs ):
+			res = super( FixupTestSkel, self ).fromDB( *args, **kwargs )
+			if res:
+				self["name"] = ( self["name"] or "" ) + "-fixed"
+			return res
+
+
+@unittest.skipIf( testbed is None, "App Engine SDK not available" )
+class TestBulkOperations( unittest.TestCase ):
+	def setUp( self ):
+		self.testbed = testbed.Testbed()
+		self.testbed.activate()
+		self.testbed.init_datastore_v3_stub()
+		self.testbed.init_memcache_stub()
+		self.testbed.init_taskqueue_stub()
+		self.testbed.init_search_stub()
+
+	def tearDown( self ):
+		self.testbed.deactivate()
+
+	def makeSkels( self, skelCls, names ):
+		res = []
+		for name in names:
+			skel = skelCls()
+			skel["name"] = name
+			res.append( skel )
+		return res
+
+	def testRoundTrip( self ):
+		keys = BulkTestSkel.toDBMulti( self.makeSkels( BulkTestSkel, [ "a", "b", "c" ] ) )
+		self.assertEqual( len( keys ), 3 )
+		skels = BulkTestSkel.fromDBMulti( keys )
+		self.assertEqual( [ x["name"] for x in skels ], [ "a", "b", "c" ] )
+
+	def testMissingEntities( self ):
+		keys = BulkTestSkel.toDBMulti( self.makeSkels( BulkTestSkel, [ "a" ] ) )
+		from server import db
+		missingKey = str( db.Key.from_path( BulkTestSkel.kindName, 4711 ) )
+		skels = BulkTestSkel.fromDBMulti( [ missingKey ] + keys )
+		self.assertIsNone( skels[ 0 ] )
+		self.assertEqual( skels[ 1 ]["name"], "a" )
+
+	def testOverriddenFromDB( self ):
+		keys = FixupTestSkel.toDBMulti( self.makeSkels( FixupTestSkel, [ "a", "b" ] ) )
+		self.assertEqual( [ x["name"] for x in FixupTestSkel.fromDBMulti( keys ) ], [ "a-fixed", "b-fixed" ] )
+
+	def testUniqueConflictSkipsOnlyThatSkeleton( self ):
+		BulkTestSkel.toDBMulti( self.makeSkels( BulkTestSkel, [ "taken" ] ) )
+		keys = BulkTestSkel.toDBMulti( self.makeSkels( BulkTestSkel, [ "x", "taken", "y" ] ) )
+		self.assertIsNotNone( keys[ 0 ] )
+		self.assertIsNone( keys[ 1 ] )
+		self.assertIsNotNone( keys[ 2 ] )
+		self.assertEqual( sorted( [ x["name"] for x in BulkTestSkel.fromDBMulti( [ keys[ 0 ], keys[ 2 ] ] ) ] ), [ "x", "y" ] )
+
+	def testUnchangedSaveClearsUpdateTag( self ):
+		from server import db
+		skel = self.makeSkels( BulkTestSkel, [ "a" ] )[ 0 ]
+		key = skel.toDB( clearUpdateTag=False )
+		self.assertTrue( db.Get( key )[ "viur_delayed_update_tag" ] )
+		changedate = db.Get( key )[ "changedate" ]
+		skel = BulkTestSkel()
+		skel.fromDB( key )
+		skel.toDB( clearUpdateTag=True )
+		self.assertEqual( db.Get( key )[ "viur_delayed_update_tag" ], 0 )
+		self.assertEqual( db.Get( key )[ "changedate" ], changedate )
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import unittest, os
+
+try:
+	from google.appengine.ext import testbed
+except ImportError:  # Not running inside the App Engine SDK
+	testbed = None
+
+_calls = []
+
+if testbed is not None:
+	from server.tasks import callDeferred
+
+	@callDeferred
+	def recordCall( value ):
+		_calls.append( value )
+
+
+class FakeRequest( object ):
+	language = None
+
+
+@unittest.skipIf( testbed is None, "App Engine SDK not available" )
+class TestCallDeferredInTasks( unittest.TestCase ):
+	def setUp( self ):
+		self.testbed = testbed.Testbed()
+		self.testbed.activate()
+		self.testbed.init_datastore_v3_stub()
+		self.testbed.init_memcache_stub()
+		self.testbed.init_taskqueue_stub()
+		self.taskqueue = self.testbed.get_stub( testbed.TASKQUEUE_SERVICE_NAME )
+		# Pretend we're running inside a task
+		from server import request
+		request.current.setRequest( FakeRequest() )
+		os.environ[ "HTTP_X_APPENGINE_TASKRETRYCOUNT" ] = "0"
+		del _calls[ : ]
+
+	def tearDown( self ):
+		del os.environ[ "HTTP_X_APPENGINE_TASKRETRYCOUNT" ]
+		from server import request
+		request.current.setRequest( None )
+		self.testbed.deactivate()
+
+	def queuedTasks( self ):
+		return( self.taskqueue.get_filtered_tasks( queue_names=[ "default" ] ) )
+
+	def testFirstCallRunsDirectly( self ):
+		recordCall( 1 )
+		self.assertEqual( _calls, [ 1 ] )
+		self.assertEqual( len( self.queuedTasks() ), 0 )
+		recordCall( 2 )
+		self.assertEqual( _calls, [ 1 ] )
+		self.assertEqual( len( self.queuedTasks() ), 1 )
+
+	def testNamedCallIsQueued( self ):
+		recordCall( 1, _name="viur-test-named", _countdown=5 )
+		self.assertEqual( _calls, [] )
+		self.assertEqual( [ x.name for x in self.queuedTasks() ], [ "viur-test-named" ] )
+
+	def testTransactionalCallIsQueued( self ):
+		from server import db
+		db.RunInTransaction( lambda: recordCall( 1, _transactional=True ) )
+		self.assertEqual( _calls, [] )
+		self.assertEqual( len( self.queuedTasks() ), 1 )
+
+	def testUpdateRelationsIsCoalesced( self ):
+		from server import skeleton
+		skeleton.scheduleUpdateRelations( "someKey" )
+		self.assertEqual( len( self.queuedTasks() ), 1 )
+		skeleton.scheduleUpdateRelations( "someKey" )
+		self.assertEqual( len( self.queuedTasks() ), 1 )
+		self.assertTrue( self.queuedTasks()[ 0 ].name.startswith( "viur-updateRelations-" ) )
+
+
+if __name__ == "__main__":
+	unittest.main()
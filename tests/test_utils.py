@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+import unittest, hmac, hashlib
+
+try:
+	from google.appengine.ext import testbed
+except ImportError:  # Not running inside the App Engine SDK
+	testbed = None
+
+
+@unittest.skipIf( testbed is None, "App Engine SDK not available" )
+class TestGetSecret( unittest.TestCase ):
+	def setUp( self ):
+		self.testbed = testbed.Testbed()
+		self.testbed.activate()
+		self.testbed.init_datastore_v3_stub()
+		self.testbed.init_memcache_stub()
+		from server import utils
+		utils._secrets.clear()
+
+	def tearDown( self ):
+		self.testbed.deactivate()
+
+	def testStoredSecretIsUsableAsHmacKey( self ):
+		from server import db, utils
+		dbObj = db.Entity( "viur-secrets", name="test" )
+		dbObj["secret"] = u"ab" * 32  # The datastore hands out strings as unicode
+		db.Put( dbObj )
+		secret = utils.getSecret( "test" )
+		self.assertIsInstance( secret, str )
+		self.assertEqual( secret, "ab" * 32 )
+		hmac.new( secret, "data", hashlib.sha256 ).digest()
+
+	def testNewSecret( self ):
+		from server import utils
+		secret = utils.getSecret( "new" )
+		self.assertIsInstance( secret, str )
+		self.assertEqual( len( secret ), 64 )
+		utils._secrets.clear()
+		self.assertEqual( utils.getSecret( "new" ), secret )
+
+
+if __name__ == "__main__":
+	unittest.main()
@@ -26,6 +26,40 @@ def generateRandomString( length=13 ):
 				for x in range( length ) ] ) )
 
 
+_secrets = {}
+
+def getSecret( name ):
+	"""
+	Returns the application-wide secret *name*, suitable for signing data (HMAC).
+
+	Secrets are generated randomly on first use and stored in the datastore (kind viur-secrets),
+	so all instances share them and they survive deployments. Use a different name for each purpose.
+
+	:type name: str
+	:param name: Purpose of the secret (eg. "session").
+
+	:returns: The secret as string of 64 hexadecimal characters.
+	:rtype: str
+	"""
+	if name in _secrets:
+		return( _secrets[ name ] )
+
+	def getOrCreateTxn( name ):
+		key = db.Key.from_path( "viur-secrets", name )
+		try:
+			return( db.Get( key )["secret"] )
+		except db.EntityNotFoundError:
+			dbObj = db.Entity( "viur-secrets", name=name )
+			dbObj["secret"] = os.urandom( 32 ).encode( "hex" )
+			dbObj.set_unindexed_properties( ["secret"] )
+			db.Put( dbObj )
+			return( dbObj["secret"] )
+
+	# The datastore returns unicode, but hmac requires its key to be a byte string
+	_secrets[ name ] = str( db.RunInTransaction( getOrCreateTxn, name ) )
+	return( _secrets[ name ] )
+
+
 def sendEMail(dests, name, skel, extraFiles=[], cc=None, bcc=None, replyTo=None, *args, **kwargs):
 	"""
 	General purpose function for sending e-mail.